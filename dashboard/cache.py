@@ -0,0 +1,200 @@
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import json
+import os
+import pickle
+from stat import S_IMODE, S_ISDIR
+import tempfile
+import threading
+import time
+
+
+def make_key(params):
+    """Returns a short hash of a JSON-serializable dict of parameters that
+    doesn't depend on the order of its keys
+    """
+    params_json = json.dumps(params, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(params_json.encode('utf-8')).hexdigest()[:16]
+
+
+class ResultStore:
+    """A thread-safe in-memory store of computed results. It holds at most
+    `max_size` results, evicting the least recently used one first, and
+    results older than `ttl` seconds count as missing.
+    """
+
+    def __init__(self, max_size=128, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time.monotonic() - item[0] > self.ttl:
+                self._items.pop(key, None)
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+class DiskCache:
+    """A store of pickled results in `directory`, one file per key, that
+    several processes (e.g. gunicorn workers) can share. Files are written
+    atomically and results older than `ttl` seconds count as missing. Every
+    `prune_every` writes, expired files and the oldest files beyond
+    `max_entries` are deleted.
+
+    Loading a pickle can run arbitrary code, so `directory` must be a
+    directory owned by this user that nobody else can access. It's created
+    that way if it doesn't exist, and a PermissionError is raised if it
+    exists and isn't.
+    """
+
+    def __init__(self, directory, max_entries=1024, ttl=600, prune_every=64):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        check_private_directory(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                raise FileNotFoundError(path)
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Stores `value` under `key`. Failing to write (e.g. a full disk)
+        only means the result isn't shared, so errors are ignored.
+        """
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            suffix='.tmp')
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            return
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._writes += 1
+        if self._writes % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pkl'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        entries.sort(reverse=True)
+        now = time.time()
+        for i, (mtime, path) in enumerate(entries):
+            if i >= self.max_entries or now - mtime > self.ttl:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def check_private_directory(directory):
+    """Raises a PermissionError unless `directory` is a directory (not a
+    link to one) owned by this user without any group or other permissions
+    """
+    stat = os.lstat(directory)
+    if not S_ISDIR(stat.st_mode):
+        raise PermissionError(f'{directory} is not a directory')
+    if stat.st_uid != os.geteuid():
+        raise PermissionError(f'{directory} is owned by another user')
+    if S_IMODE(stat.st_mode) & 0o077:
+        raise PermissionError(
+            f'{directory} can be accessed by other users (mode '
+            f'{S_IMODE(stat.st_mode):o}), run chmod 700 on it to use it'
+        )
+
+
+def memoize(store=None, shared=None, normalize=None, namespace=''):
+    """Decorator that caches a function's results by a hash of its arguments.
+
+    Results are looked up in the process-local `store` (a new ResultStore per
+    function by default), then in the `shared` cache (e.g. a DiskCache) if
+    given, and only computed on a miss in both. `normalize(*args, **kwargs)`
+    can map equivalent arguments to the same JSON-serializable value, e.g. by
+    sorting a list that is really a set. Results must not be modified by
+    callers. `namespace` is added to every key, e.g. to tell data versions
+    apart. The number of calls answered by each cache and computed is kept in
+    the wrapper's `cache_counts` dict.
+    """
+    def decorator(func):
+        name = f'{namespace}:{func.__module__}.{func.__qualname__}'
+        local = store if store is not None else ResultStore()
+        counts = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if normalize is None:
+                call = {'args': args, 'kwargs': kwargs}
+            else:
+                call = normalize(*args, **kwargs)
+            key = make_key({'func': name, 'call': call})
+            value = local.get(key)
+            if value is not None:
+                counts['local_hits'] += 1
+                return value
+            if shared is not None:
+                value = shared.get(key)
+                if value is not None:
+                    counts['shared_hits'] += 1
+                    local.set(key, value)
+                    return value
+            counts['misses'] += 1
+            value = func(*args, **kwargs)
+            local.set(key, value)
+            if shared is not None:
+                shared.set(key, value)
+            return value
+
+        wrapper.store = local
+        wrapper.shared = shared
+        wrapper.cache_counts = counts
+        return wrapper
+    return decorator
@@ -0,0 +1,195 @@
+from functools import wraps
+import gzip
+import io
+import logging
+import mimetypes
+import os
+import tempfile
+
+import click
+from flask import request, safe_join, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Types of files and responses worth compressing. Images and woff fonts are
+# already compressed.
+COMPRESSIBLE_EXTENSIONS = {
+    '.css', '.eot', '.html', '.ico', '.js', '.json', '.otf', '.svg', '.ttf',
+    '.txt',
+}
+COMPRESSIBLE_MIMETYPES = {
+    'application/javascript', 'application/json', 'image/svg+xml',
+    'text/css', 'text/html', 'text/plain',
+}
+# Content encodings and the suffixes of precompressed copies, best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def get_encodings():
+    """Returns the content encodings this process can compress with, best
+    first. Brotli needs the optional `brotli` package.
+    """
+    return [encoding for encoding, _ in ENCODINGS
+            if encoding != 'br' or brotli is not None]
+
+
+def compress(data, encoding, level):
+    """Returns the bytes `data` compressed with `encoding`, at gzip level or
+    brotli quality `level`
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    # a fixed mtime so the same data always compresses to the same bytes
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level,
+                       mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def get_accepted_encoding(encodings):
+    """Returns the first of `encodings` the client accepts, or None"""
+    for encoding in encodings:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def is_current(path, compressed_path):
+    return (os.path.isfile(compressed_path)
+            and os.path.getmtime(compressed_path) >= os.path.getmtime(path))
+
+
+def precompress_directory(directory, min_size=1024, gzip_level=9,
+                          brotli_quality=11):
+    """Writes a compressed copy of each compressible file in `directory` of
+    at least `min_size` bytes, next to the file, with the suffix of each
+    encoding in `get_encodings`. Copies newer than their file are kept, and
+    copies that wouldn't be smaller than the file aren't written. Returns the
+    paths of the copies written.
+    """
+    levels = {'br': brotli_quality, 'gzip': gzip_level}
+    suffixes = dict(ENCODINGS)
+    written = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if (os.path.splitext(name)[1] not in COMPRESSIBLE_EXTENSIONS
+                    or os.path.getsize(path) < min_size):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            for encoding in get_encodings():
+                compressed_path = path + suffixes[encoding]
+                if is_current(path, compressed_path):
+                    continue
+                compressed = compress(data, encoding, levels[encoding])
+                if len(compressed) >= len(data):
+                    continue
+                fd, tmp_path = tempfile.mkstemp(dir=root, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(compressed)
+                os.replace(tmp_path, compressed_path)
+                written.append(compressed_path)
+    return written
+
+
+def install_compression(server, min_size=1024, gzip_level=6,
+                        brotli_quality=4):
+    """Makes the Flask app `server` send compressed responses to clients
+    that accept them.
+
+    Static files are sent as their precompressed copy (see
+    `precompress_directory`) in the best encoding the client accepts, if
+    there's a copy newer than the file. Other responses of a compressible
+    type of at least `min_size` bytes, like Dash layout and callback JSON,
+    are compressed as they're sent, at the lower `gzip_level` or
+    `brotli_quality` as that's done for every response.
+    """
+    send_static_file = server.view_functions.get('static')
+    if send_static_file is not None:
+        server.view_functions['static'] = get_compressed_static_view(
+            server, send_static_file
+        )
+    levels = {'br': brotli_quality, 'gzip': gzip_level}
+
+    @server.after_request
+    def compress_response(response):
+        if (response.status_code != 200 or response.direct_passthrough
+                or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = get_accepted_encoding(get_encodings())
+        if encoding is None:
+            return response
+        response.set_data(compress(data, encoding, levels[encoding]))
+        response.headers['Content-Encoding'] = encoding
+        # the compressed response is still the same resource, so the ETag
+        # stays valid for conditional requests, but only as a weak one
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    return server
+
+
+def get_compressed_static_view(server, send_static_file):
+    """Returns a view for the static files of `server` that sends the
+    current precompressed copy of a file in the best encoding the client
+    accepts, and the file itself with `send_static_file` otherwise
+    """
+    suffixes = dict(ENCODINGS)
+
+    @wraps(send_static_file)
+    def send_compressed_static_file(filename):
+        path = safe_join(server.static_folder, filename)
+        encodings = []
+        if path is not None and os.path.isfile(path):
+            encodings = [encoding for encoding, suffix in ENCODINGS
+                         if is_current(path, path + suffix)]
+        encoding = get_accepted_encoding(encodings)
+        if encoding is None:
+            response = send_static_file(filename)
+        else:
+            response = send_from_directory(
+                server.static_folder, filename + suffixes[encoding],
+                mimetype=mimetypes.guess_type(filename)[0],
+                cache_timeout=server.get_send_file_max_age(filename),
+            )
+            response.headers['Content-Encoding'] = encoding
+        if encodings:
+            response.vary.add('Accept-Encoding')
+        return response
+
+    return send_compressed_static_file
+
+
+@click.command()
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--min-size', type=click.INT, default=1024,
+              help='Smallest file size to compress in bytes')
+def main(directory, min_size=1024):
+    """Precompresses the static files in DIRECTORY (e.g. dashboard/static)
+    for the dashboard servers to send to clients that accept them
+    """
+    logger = logging.getLogger(__name__)
+    if brotli is None:
+        logger.warning('brotli is not installed, only writing .gz files')
+    for path in precompress_directory(directory, min_size):
+        logger.info(f'wrote {path}')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
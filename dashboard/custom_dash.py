@@ -1,15 +1,102 @@
+from functools import lru_cache
+import hashlib
+import os
+
 from dash import Dash
+from flask import Response, request
+
+
+def get_file_hash(path):
+    """Returns a short hash of the contents of the file `path`, only read
+    again when its size or modification time changes
+    """
+    stat = os.stat(path)
+    return _hash_file(path, stat.st_mtime, stat.st_size)
+
+
+@lru_cache(maxsize=256)
+def _hash_file(path, mtime, size):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
 
 
 class CustomIndexDash(Dash):
-    """Custom Dash class overriding index() method for local CSS support"""
-    def _generate_css_custom_html(self):
-        link_str = '<link rel="stylesheet" href="{}/{}">'
+    """Custom Dash class overriding index() method for local CSS support.
+
+    The index is rendered once for each configuration of the app and served
+    with an ETag, so browsers can revalidate it without downloading it
+    again. The configuration is checked on every request by
+    `_get_index_state`, so the index is rendered again when the title,
+    layout, resources or stylesheets change. Stylesheet URLs include a hash
+    of the file's contents, so they can be cached for as long as browsers
+    like and still change whenever the file does.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (state, index, etag) of the last rendered index
+        self._index = None
+
+    def get_static_path(self, path):
+        return os.path.join(self.server.root_path,
+                            self.server.config['STATIC_FOLDER'], path)
+
+    def get_static_url(self, path):
+        """Returns the URL of the static file `path` with the hash of its
+        contents as the `v` query parameter
+        """
         static_url_path = self.server.config['STATIC_URL_PATH']
-        return '\n'.join(link_str.format(static_url_path, path)
+        file_hash = get_file_hash(self.get_static_path(path))
+        return f'{static_url_path}/{path}?v={file_hash}'
+
+    def _generate_css_custom_html(self):
+        link_str = '<link rel="stylesheet" href="{}">'
+        return '\n'.join(link_str.format(self.get_static_url(path))
                          for path in self.server.config['STYLESHEETS'])
 
+    def _get_index_state(self):
+        """Returns a tuple of everything the rendered index depends on that's
+        cheap to check: the title and config, the layout object and number
+        of resources appended to `css` and `scripts`, and the size and
+        modification time of each stylesheet. Layouts are compared by
+        identity, so a layout changed in place after the first request isn't
+        noticed.
+        """
+        stylesheets = []
+        for path in self.server.config['STYLESHEETS']:
+            stat = os.stat(self.get_static_path(path))
+            stylesheets.append((path, stat.st_mtime, stat.st_size))
+        return (
+            getattr(self, 'title', 'Dash'),
+            self.url_base_pathname,
+            self.config['requests_pathname_prefix'],
+            self.css.config.serve_locally,
+            self.scripts.config.serve_locally,
+            self._dev_tools.serve_dev_bundles,
+            tuple(self._external_stylesheets),
+            tuple(self._external_scripts),
+            id(self.css._resources.layout),
+            id(self.scripts._resources.layout),
+            len(self.css._resources._resources),
+            len(self.scripts._resources._resources),
+            tuple(stylesheets),
+        )
+
     def index(self, *args, **kwargs):
+        state = self._get_index_state()
+        if self._index is None or self._index[0] != state:
+            index = self.render_index()
+            etag = hashlib.sha1(index.encode('utf-8')).hexdigest()
+            self._index = (state, index, etag)
+        _, index, etag = self._index
+        response = Response(index, mimetype='text/html')
+        response.set_etag(etag)
+        # always check with the server, which only sends the index again if
+        # it changed
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    def render_index(self):
         scripts = self._generate_scripts_html()
         css = self._generate_css_dist_html()
         custom_css = self._generate_css_custom_html()
@@ -0,0 +1,188 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+# Columns of weekly scores, like '2017-01'
+WEEK_COLUMN = re.compile(r'^\d{4}-\d{2}$')
+# Version of the layout of compact summary directories, so that directories
+# written by an older version get rebuilt
+COMPACT_FORMAT = 1
+
+
+def find_summary_file(path):
+    """Returns the typed parquet file of the scores summary `path` (without an
+    extension) written by src/data/make_dataset.py if it exists, as it loads
+    much faster than parsing the csv, or the csv file otherwise
+    """
+    if os.path.exists(path + '.parquet'):
+        return path + '.parquet'
+    return path + '.csv'
+
+
+def read_summary(summary_file):
+    if summary_file.endswith('.parquet'):
+        return pd.read_parquet(summary_file)
+    return pd.read_csv(summary_file)
+
+
+def get_compact_dtype(column, values):
+    """Returns the dtype a summary column is kept in: int32 player ids,
+    float32 weekly scores, categories for text like teams and positions, and
+    float64 for the season statistics, so their rounding and sort order don't
+    change
+    """
+    if column == 'player_id':
+        return 'int32'
+    if not is_numeric_dtype(values):
+        return 'category'
+    if WEEK_COLUMN.match(str(column)):
+        return 'float32'
+    return 'float64'
+
+
+def compact_summary(df):
+    """Returns the scores summary `df` in the dtypes of `get_compact_dtype`,
+    with missing scores as 0. Summaries made before the player registry
+    existed have no ids, so their players are numbered in order.
+    """
+    df = df.copy()
+    if 'player_id' not in df.columns:
+        df.insert(0, 'player_id', np.arange(len(df)))
+    for column in df.columns:
+        dtype = get_compact_dtype(column, df[column])
+        if dtype == 'category':
+            df[column] = df[column].astype(str).astype('category')
+        else:
+            df[column] = df[column].fillna(0).astype(dtype)
+    return df
+
+
+def get_blocks(df):
+    """Returns (dtype, columns) pairs splitting the columns of `df` into runs
+    of consecutive columns with the same dtype, with each categorical column
+    on its own
+    """
+    blocks = []
+    for column in df.columns:
+        dtype = str(df[column].dtype)
+        if blocks and blocks[-1][0] == dtype and dtype != 'category':
+            blocks[-1][1].append(column)
+        else:
+            blocks.append((dtype, [column]))
+    return blocks
+
+
+def save_compact_summary(df, directory, source=None):
+    """Writes the compact summary `df` to the new directory `directory`, as
+    an .npy file for each block of `get_blocks` (codes for categorical
+    columns) and their columns and categories in meta.json. `source`
+    identifies the file `df` was read from.
+    """
+    os.makedirs(directory)
+    blocks = []
+    for i, (dtype, columns) in enumerate(get_blocks(df)):
+        block = {'file': f'block-{i}.npy', 'columns': columns}
+        if dtype == 'category':
+            values = df[columns[0]].cat.codes.values
+            block['categories'] = df[columns[0]].cat.categories.tolist()
+        else:
+            values = np.ascontiguousarray(df[columns].values)
+        np.save(os.path.join(directory, block['file']), values)
+        blocks.append(block)
+    meta = {'format': COMPACT_FORMAT, 'source': source, 'blocks': blocks}
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def write_compact_summary(df, directory, source=None):
+    """Replaces `directory` with the compact summary `df` atomically, so that
+    other processes only ever see a complete summary. Raises an OSError if it
+    can't be written, e.g. on a read-only file system or when another process
+    replaced it first.
+    """
+    parent = os.path.dirname(os.path.abspath(directory))
+    tmp_dir = tempfile.mkdtemp(dir=parent, suffix='.tmp')
+    try:
+        save_compact_summary(df, os.path.join(tmp_dir, 'summary'), source)
+        if os.path.exists(directory):
+            # Processes that mapped the old files keep reading them after
+            # they're deleted
+            os.rename(directory, os.path.join(tmp_dir, 'old'))
+        os.rename(os.path.join(tmp_dir, 'summary'), directory)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_compact_meta(directory):
+    try:
+        with open(os.path.join(directory, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_compact_summary(directory, mmap_mode='r'):
+    """Returns the summary written by `save_compact_summary` to `directory`.
+    With a `mmap_mode`, every column is a view of a memory-mapped file rather
+    than a copy in memory.
+    """
+    meta = read_compact_meta(directory)
+    frames = []
+    for block in meta['blocks']:
+        values = np.load(os.path.join(directory, block['file']),
+                         mmap_mode=mmap_mode)
+        if 'categories' in block:
+            values = pd.Categorical.from_codes(values, block['categories'])
+            frames.append(pd.DataFrame({block['columns'][0]: values}))
+        else:
+            frames.append(
+                pd.DataFrame(values, columns=block['columns'], copy=False)
+            )
+    # Concatenating without copying keeps the blocks memory-mapped, where
+    # reindexing or assigning columns would copy them
+    return pd.concat(frames, axis=1, copy=False)
+
+
+def get_source_stamp(summary_file):
+    return [
+        os.path.basename(summary_file),
+        os.path.getmtime(summary_file),
+        os.path.getsize(summary_file),
+    ]
+
+
+def load_summary(summary_file, mmap=True):
+    """Returns the compact scores summary (see `compact_summary`) read from
+    the parquet or csv file `summary_file`.
+
+    With `mmap`, the summary is read from a binary copy next to the file,
+    `<name>.compact/`, which is built the first time and again whenever the
+    file changes. Its columns are memory-mapped read-only, so every process
+    that loads it (e.g. each gunicorn worker) shares the same pages of memory
+    instead of holding its own copy. If the copy can't be written, the
+    summary is kept in memory instead.
+    """
+    if not mmap:
+        return compact_summary(read_summary(summary_file))
+    directory = os.path.splitext(summary_file)[0] + '.compact'
+    source = get_source_stamp(summary_file)
+
+    def is_current():
+        meta = read_compact_meta(directory)
+        return (meta is not None and meta.get('format') == COMPACT_FORMAT
+                and meta.get('source') == source)
+
+    if not is_current():
+        df = compact_summary(read_summary(summary_file))
+        try:
+            write_compact_summary(df, directory, source)
+        except OSError:
+            if not is_current():
+                return df
+    return load_compact_summary(directory)
@@ -0,0 +1,48 @@
+import numpy as np
+
+
+class PositionTraces:
+    """Scatter trace fragments for each position, prebuilt once so that the
+    traces for any set of rows are assembled by masking arrays instead of
+    grouping a frame.
+
+    For each position, the fragment holds the position's rows in the query
+    index's order (best first) and, in the same order, the values of each of
+    `columns`, a dict of arrays aligned with the rows of `query_index.df`.
+    """
+
+    def __init__(self, query_index, columns, colors):
+        self.num_rows = len(query_index.df)
+        self.colors = colors
+        self.fragments = {}
+        for position in sorted(colors):
+            rows = query_index.position_order.get(position)
+            if rows is None:
+                continue
+            fragment = {'rows': rows}
+            for name, values in columns.items():
+                fragment[name] = np.asarray(values)[rows]
+            self.fragments[position] = fragment
+
+    def get_traces(self, rows, x, y, text):
+        """Returns one scatter trace per position for the row numbers `rows`,
+        with the `x`, `y` and `text` columns, ordered like a groupby on
+        position
+        """
+        selected = np.zeros(self.num_rows, dtype=bool)
+        selected[rows] = True
+        traces = []
+        for position, fragment in self.fragments.items():
+            mask = selected[fragment['rows']]
+            if not mask.any():
+                continue
+            traces.append({
+                'x': fragment[x][mask].tolist(),
+                'y': fragment[y][mask].tolist(),
+                'type': 'scatter',
+                'name': position,
+                'mode': 'markers',
+                'text': fragment[text][mask].tolist(),
+                'marker': {'size': 10, 'color': self.colors[position]},
+            })
+        return traces
@@ -0,0 +1,261 @@
+import random
+import threading
+import time
+
+from flask import Response, g, request
+
+
+class Reservoir:
+    """A uniform random sample of at most `size` of the values added to it
+    (Vitter's algorithm R), for estimating quantiles of a stream of values
+    in a fixed amount of memory
+    """
+
+    def __init__(self, size=1024, rng=None):
+        self.size = size
+        self.values = []
+        self.seen = 0
+        self.rng = rng or random.Random()
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            i = self.rng.randrange(self.seen)
+            if i < self.size:
+                self.values[i] = value
+
+    def quantiles(self, qs):
+        """Returns the nearest-rank estimates of the quantiles `qs` (e.g.
+        0.95), or NaNs if no values were added
+        """
+        values = sorted(self.values)
+        if not values:
+            return [float('nan')] * len(qs)
+        return [values[min(int(q * len(values)), len(values) - 1)]
+                for q in qs]
+
+
+class HandlerStats:
+    """Counts of all requests to one handler, and the latencies and payload
+    sizes of the sampled ones
+    """
+
+    def __init__(self, reservoir_size=1024):
+        self.requests = 0
+        self.sampled = 0
+        self.seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latencies = Reservoir(reservoir_size)
+
+
+class Metrics:
+    """Request metrics of a Flask server by handler: the id of the Dash
+    callback (like 'table.children') for callback dispatches, and the URL
+    rule (like '/_dash-layout' or '/') for everything else, so page loads
+    are counted by route rather than by every path requested.
+
+    Every request is counted, and a `sample_rate` fraction of them are timed
+    and have their request and response sizes recorded. Latency quantiles
+    are estimated from a bounded sample of those timings. Metrics are kept
+    per process, so with several gunicorn workers each scrape of
+    `render` sees the worker that answered it.
+    """
+
+    def __init__(self, sample_rate=0.1, reservoir_size=1024,
+                 quantiles=(0.5, 0.95, 0.99)):
+        self.sample_rate = sample_rate
+        self.reservoir_size = reservoir_size
+        self.quantiles = quantiles
+        self.handlers = {}
+        self.caches = {}
+        self._lock = threading.Lock()
+
+    def _get_stats(self, handler):
+        stats = self.handlers.get(handler)
+        if stats is None:
+            stats = self.handlers.setdefault(
+                handler, HandlerStats(self.reservoir_size)
+            )
+        return stats
+
+    def should_sample(self):
+        return random.random() < self.sample_rate
+
+    def count(self, handler):
+        with self._lock:
+            self._get_stats(handler).requests += 1
+
+    def record(self, handler, seconds, bytes_in, bytes_out):
+        """Counts a sampled request to `handler` that took `seconds`"""
+        with self._lock:
+            stats = self._get_stats(handler)
+            stats.requests += 1
+            stats.sampled += 1
+            stats.seconds += seconds
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            stats.latencies.add(seconds)
+
+    def watch_cache(self, handler, cache_counts):
+        """Reports `cache_counts`, the counts of a function memoized with
+        `dashboard.cache.memoize`, as the cache results of `handler`
+        """
+        self.caches[handler] = cache_counts
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format"""
+        with self._lock:
+            handlers = sorted(self.handlers.items())
+            summaries = [
+                (handler, stats.latencies.quantiles(self.quantiles),
+                 stats.seconds, stats.sampled)
+                for handler, stats in handlers
+            ]
+        lines = [
+            '# HELP dash_requests_total Requests by Dash callback or route',
+            '# TYPE dash_requests_total counter',
+        ]
+        lines.extend(
+            f'dash_requests_total{{handler="{escape_label(handler)}"}} '
+            f'{stats.requests}'
+            for handler, stats in handlers
+        )
+        lines.extend([
+            '# HELP dash_request_duration_seconds Latency of sampled requests',
+            '# TYPE dash_request_duration_seconds summary',
+        ])
+        for handler, values, seconds, sampled in summaries:
+            name = 'dash_request_duration_seconds'
+            handler = escape_label(handler)
+            for q, value in zip(self.quantiles, values):
+                lines.append(
+                    f'{name}{{handler="{handler}",quantile="{q}"}} '
+                    f'{format_value(value)}'
+                )
+            lines.append(f'{name}_sum{{handler="{handler}"}} {seconds}')
+            lines.append(f'{name}_count{{handler="{handler}"}} {sampled}')
+        for direction in ['request', 'response']:
+            attr = 'bytes_in' if direction == 'request' else 'bytes_out'
+            name = f'dash_{direction}_bytes_total'
+            lines.extend([
+                f'# HELP {name} Payload bytes of sampled {direction}s',
+                f'# TYPE {name} counter',
+            ])
+            lines.extend(
+                f'{name}{{handler="{escape_label(handler)}"}} '
+                f'{getattr(stats, attr)}'
+                for handler, stats in handlers
+            )
+        lines.extend(self.render_caches())
+        return '\n'.join(lines) + '\n'
+
+    def render_caches(self):
+        lines = [
+            '# HELP dash_cache_results_total Memoized results by cache',
+            '# TYPE dash_cache_results_total counter',
+        ]
+        ratios = [
+            '# HELP dash_cache_hit_ratio Share of results found in a cache',
+            '# TYPE dash_cache_hit_ratio gauge',
+        ]
+        for handler, counts in sorted(self.caches.items()):
+            counts = dict(counts)
+            handler = escape_label(handler)
+            for result, count in sorted(counts.items()):
+                lines.append(
+                    f'dash_cache_results_total'
+                    f'{{handler="{handler}",result="{result}"}} {count}'
+                )
+            total = sum(counts.values())
+            hits = total - counts.get('misses', 0)
+            ratio = hits / total if total else float('nan')
+            ratios.append(f'dash_cache_hit_ratio{{handler="{handler}"}} '
+                          f'{format_value(ratio)}')
+        return lines + ratios
+
+
+def format_value(value):
+    if value != value:
+        return 'NaN'
+    return str(value)
+
+
+def escape_label(value):
+    """Returns `value` escaped for a label value of the Prometheus text
+    format
+    """
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def get_handler(req, callback_ids=None):
+    """Returns the metrics handler name of the request `req`. Dispatches to
+    one of `callback_ids` (like a Dash app's `callback_map`) are named after
+    the callback, and dispatches to any other output 'unknown_callback', so
+    clients can't add handlers of their own. Without `callback_ids`, all
+    dispatches are named after their route.
+    """
+    if callback_ids and req.path.endswith('_dash-update-component'):
+        body = req.get_json(silent=True) or {}
+        output = body.get('output')
+        if isinstance(output, dict):
+            output = f"{output.get('id')}.{output.get('property')}"
+        if isinstance(output, str) and output in callback_ids:
+            return output
+        return 'unknown_callback'
+    if req.url_rule is None:
+        return 'unmatched'
+    return req.url_rule.rule
+
+
+def install_metrics(server, app=None, sample_rate=0.1, path='/metrics'):
+    """Records the Metrics of the requests to the Flask app `server` and
+    serves them at `path` in the Prometheus text format. With the Dash `app`,
+    callback dispatches are counted by callback (see `get_handler`) and the
+    cache results of its memoized callbacks are included too. Install it
+    before any other after-request hooks whose time and output should be
+    counted, like compression.
+    """
+    metrics = Metrics(sample_rate)
+
+    @server.before_request
+    def start_timer():
+        if metrics.should_sample():
+            g.metrics_start = time.perf_counter()
+
+    @server.after_request
+    def record_request(response):
+        # look the request up once rather than through the proxy each time
+        req = request._get_current_object()
+        if req.path == path:
+            return response
+        start = g.pop('metrics_start', None)
+        handler = get_handler(
+            req, app.callback_map if app is not None else None
+        )
+        if start is None:
+            metrics.count(handler)
+            return response
+        metrics.record(
+            handler,
+            time.perf_counter() - start,
+            req.content_length or 0,
+            response.content_length or 0,
+        )
+        return response
+
+    def serve_metrics():
+        if app is not None:
+            for callback_id, callback in app.callback_map.items():
+                counts = getattr(callback.get('callback'), 'cache_counts',
+                                 None)
+                if counts is not None:
+                    metrics.watch_cache(callback_id, counts)
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    server.add_url_rule(path, 'metrics', serve_metrics)
+    return metrics
@@ -4,9 +4,20 @@ import dash_html_components as html
 from .components import Col, Row
 
 
-page1 = html.Div("Page 1")
-page2 = html.Div("Page 2")
-page3 = html.Div("Page 3")
+# Each page is a function returning its layout, which the router calls the
+# first time the page is visited
+
+
+def page1():
+    return html.Div("Page 1")
+
+
+def page2():
+    return html.Div("Page 2")
+
+
+def page3():
+    return html.Div("Page 3")
 
 
 def page_not_found(pathname):
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+
+class Ranking:
+    """All rows of a frame ordered by the values of a metric, highest first
+    with ties in frame order, the rank of each row in that order, and the
+    same order split by position (a dict of arrays of row numbers). Built
+    once, so the best rows of any set of positions can be picked without
+    sorting.
+    """
+
+    def __init__(self, values, positions):
+        self.order = np.argsort(-np.asarray(values), kind='mergesort')
+        self.rank = np.empty_like(self.order)
+        self.rank[self.order] = np.arange(len(self.order))
+        ordered_positions = positions[self.order]
+        self.position_order = {
+            position: self.order[ordered_positions == position]
+            for position in pd.unique(positions)
+        }
+
+
+class QueryIndex:
+    """Answers top-N player queries on a scores summary without sorting,
+    grouping or copying it.
+
+    Built once at load time: a Ranking of all rows by `sort_column` and a
+    hash index from player id to row number for excluding players. Players
+    can also be ranked by any other column or by one of `metrics`, a dict of
+    arrays of values aligned with the rows of `df` (e.g. derived scores that
+    aren't columns), and orders by other columns, for sorting results. Those
+    are built the first time they're needed. `df` must have a RangeIndex, so
+    that row numbers and index labels are the same.
+    """
+
+    def __init__(self, df, sort_column='week_avg', metrics=None):
+        self.df = df
+        self.sort_column = sort_column
+        self.metrics = dict(metrics or {})
+        self.positions = df['position'].values
+        self.position_codes, position_names = pd.factorize(self.positions)
+        self.position_numbers = {
+            position: i for i, position in enumerate(position_names)
+        }
+        self.rankings = {}
+        ranking = self.get_ranking(sort_column)
+        self.order = ranking.order
+        self.rank = ranking.rank
+        self.position_order = ranking.position_order
+        self.player_rows = pd.Index(df['player_id'])
+        self.sort_orders = {}
+
+    def get_ranking(self, metric=None):
+        """Returns the Ranking of all rows by `metric`, a column of the frame
+        or one of `metrics`, or by `sort_column` if it's None
+        """
+        metric = metric or self.sort_column
+        if metric not in self.rankings:
+            if metric in self.metrics:
+                values = self.metrics[metric]
+            else:
+                values = self.df[metric].values
+            self.rankings[metric] = Ranking(values, self.positions)
+        return self.rankings[metric]
+
+    def get_excluded(self, player_ids):
+        """Returns a boolean array that is True for the rows of `player_ids`.
+        Ids that aren't in the frame are ignored.
+        """
+        excluded = np.zeros(len(self.df), dtype=bool)
+        if player_ids:
+            rows = self.player_rows.get_indexer(player_ids)
+            excluded[rows[rows >= 0]] = True
+        return excluded
+
+    def get_position_mask(self, positions):
+        """Returns a boolean array that is True for the rows of `positions`"""
+        wanted = np.zeros(len(self.position_numbers), dtype=bool)
+        wanted[[self.position_numbers[position] for position in positions
+                if position in self.position_numbers]] = True
+        return wanted[self.position_codes]
+
+    def top_rows(self, positions, num_rows, per_position=True,
+                 excluded_ids=None, metric=None):
+        """Returns the row numbers of the players to show, best first by
+        `metric` (see `get_ranking`).
+
+        With `per_position`, that's the top `num_rows` of each of `positions`,
+        taken from the presorted arrays and merged by rank. Otherwise it's the
+        top `num_rows` of all of `positions` together, taken from the
+        presorted order of all rows with other positions and excluded players
+        masked out.
+        """
+        ranking = self.get_ranking(metric)
+        excluded = self.get_excluded(excluded_ids)
+        if not per_position:
+            allowed = self.get_position_mask(positions) & ~excluded
+            return ranking.order[allowed[ranking.order]][:num_rows]
+        chunks = []
+        for position in positions:
+            rows = ranking.position_order.get(position, ranking.order[:0])
+            if excluded.any():
+                rows = rows[~excluded[rows]]
+            chunks.append(rows[:num_rows])
+        if not chunks:
+            return ranking.order[:0]
+        rows = np.concatenate(chunks)
+        return rows[np.argsort(ranking.rank[rows], kind='mergesort')]
+
+    def top(self, positions, num_rows, per_position=True, excluded_ids=None,
+            columns=None, metric=None):
+        """Returns a dataframe of the rows of `top_rows`, with only `columns`
+        if given
+        """
+        rows = self.top_rows(positions, num_rows, per_position, excluded_ids,
+                             metric)
+        if columns is None:
+            return self.df.iloc[rows]
+        return self.df.iloc[rows, self.df.columns.get_indexer(columns)]
+
+    def get_sort_order(self, column, ascending=True):
+        """Returns all row numbers sorted by `column`, with ties in frame
+        order
+        """
+        key = (column, ascending)
+        if key not in self.sort_orders:
+            codes = pd.factorize(self.df[column].values, sort=True)[0]
+            if not ascending:
+                codes = -codes
+            self.sort_orders[key] = np.argsort(codes, kind='mergesort')
+        return self.sort_orders[key]
+
+    def sort_rows(self, rows, column, ascending=True):
+        """Returns the row numbers `rows` sorted by `column`, by picking them
+        out of the presorted order of all rows
+        """
+        order = self.get_sort_order(column, ascending)
+        selected = np.zeros(len(self.df), dtype=bool)
+        selected[rows] = True
+        return order[selected[order]]
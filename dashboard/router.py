@@ -1,3 +1,6 @@
+from functools import lru_cache
+import threading
+
 from dash.dependencies import Output, Input
 
 from .server import app, server
@@ -7,9 +10,56 @@ from .utils import get_url
 from .exceptions import HaltCallback
 
 
+class RouteRegistry:
+    """The layouts of the pages of the app by path.
+
+    A page's layout is built by calling its function the first time the page
+    is visited, and the same layout is returned on every later visit, so
+    pages nobody visits are never built. Pages registered with
+    `dynamic=True` have their function called on every visit instead, for
+    pages whose content changes between requests.
+    """
+
+    def __init__(self, routes=()):
+        self.routes = {}
+        self.layouts = {}
+        self._lock = threading.Lock()
+        for route, layout in routes:
+            self.add(route, layout)
+
+    def add(self, route, layout, dynamic=False):
+        """Registers the page function `layout` at `route`, a path that will
+        be prefixed with URL_BASE_PATHNAME
+        """
+        self.routes[get_url(route)] = (layout, dynamic)
+
+    def route(self, route, dynamic=False):
+        """Decorator version of `add`"""
+        def decorator(layout):
+            self.add(route, layout, dynamic)
+            return layout
+        return decorator
+
+    def get_layout(self, pathname):
+        """Returns the layout of the page at `pathname`, or None if there's
+        no page there. Layouts are cached by page function, so routes that
+        share a page share its layout.
+        """
+        if pathname not in self.routes:
+            return None
+        layout, dynamic = self.routes[pathname]
+        if dynamic:
+            return layout()
+        if layout not in self.layouts:
+            with self._lock:
+                if layout not in self.layouts:
+                    self.layouts[layout] = layout()
+        return self.layouts[layout]
+
+
 # Ordered iterable of routes: tuples of (route, layout), where 'route' is a
 # string corresponding to path of the route (will be prefixed with
-# URL_BASE_PATHNAME) and 'layout' is a Dash Component.
+# URL_BASE_PATHNAME) and 'layout' is a function returning a Dash Component.
 urls = (
     ('', page1),
     ('page1', page1),
@@ -18,15 +68,25 @@ urls = (
 )
 
 
-routes = {get_url(route): layout for route, layout in urls}
+routes = RouteRegistry(urls)
 
 
 @app.callback(Output(server.config['CONTENT_CONTAINER_ID'], 'children'),
               [Input('url', 'pathname')])
 def router(pathname):
     """The router"""
-    default_layout = page_not_found(pathname)
-    return routes.get(pathname, default_layout)
+    layout = routes.get_layout(pathname)
+    if layout is None:
+        return page_not_found(pathname)
+    return layout
+
+
+@lru_cache(maxsize=64)
+def get_navbar(pathname):
+    """Returns the navbar with the page at `pathname` set to active, built
+    once for each of the most recently visited paths
+    """
+    return Navbar(items=server.config['NAV_ITEMS'], current_path=pathname)
 
 
 if server.config['NAVBAR']:
@@ -37,4 +97,4 @@ if server.config['NAVBAR']:
         if pathname is None:
             # pathname is None on the first load of the app; ignore this
             raise HaltCallback("Ignoring first url.pathname callback")
-        return Navbar(items=server.config['NAV_ITEMS'], current_path=pathname)
+        return get_navbar(pathname)
@@ -0,0 +1,51 @@
+import re
+
+import numpy as np
+
+
+class PlayerSearchIndex:
+    """Prefix search over player names that returns the best `k` matches.
+
+    Each name is split into lowercase tokens, the whole name and each part
+    between '.', '-' and spaces, so 'T.Gurley' is found by 't.g' or 'gur'.
+    All tokens are kept in one sorted array, so the matches for a prefix are
+    one slice of it, found by binary search. Names that only contain the
+    query somewhere in the middle are used to fill up the results when there
+    are fewer than `k` prefix matches. Matches are ordered by `ranks`, lowest
+    first (e.g. each player's rank by weekly average).
+    """
+
+    def __init__(self, names, ranks):
+        self.names = np.array([str(name).lower() for name in names])
+        self.ranks = np.asarray(ranks)
+        self.by_rank = np.argsort(self.ranks, kind='mergesort')
+        tokens = []
+        token_rows = []
+        for row, name in enumerate(self.names):
+            for token in {name, *re.split(r'[.\-\s]+', name)}:
+                if token:
+                    tokens.append(token)
+                    token_rows.append(row)
+        tokens = np.array(tokens)
+        order = np.argsort(tokens, kind='mergesort')
+        self.tokens = tokens[order]
+        self.token_rows = np.array(token_rows, dtype=np.int64)[order]
+
+    def search(self, query, k=20):
+        """Returns the row numbers of the best `k` players matching `query`,
+        or of the best `k` players if `query` is empty
+        """
+        query = (query or '').strip().lower()
+        if not query:
+            return self.by_rank[:k]
+        start = np.searchsorted(self.tokens, query, side='left')
+        stop = np.searchsorted(self.tokens, query + '\uffff', side='left')
+        rows = self._by_rank(np.unique(self.token_rows[start:stop]))
+        if len(rows) < k:
+            contains = np.flatnonzero(np.char.find(self.names, query) >= 0)
+            contains = contains[~np.isin(contains, rows)]
+            rows = np.concatenate([rows, self._by_rank(contains)])
+        return rows[:k]
+
+    def _by_rank(self, rows):
+        return rows[np.argsort(self.ranks[rows], kind='mergesort')]
@@ -1,9 +1,11 @@
 import os
 import sys
 
-from flask import Flask, send_from_directory
+from flask import Flask, request, send_from_directory
 
-from .custom_dash import CustomIndexDash
+from .compression import install_compression
+from .metrics import install_metrics
+from .custom_dash import CustomIndexDash, get_file_hash
 from .exceptions import HaltCallback
 
 
@@ -20,13 +22,23 @@ server.config.from_envvar('SLAPDASH_SETTINGS', silent=True)
 
 app = CustomIndexDash(
     server=server,
-    url_base_pathname=server.config['URL_BASE_PATHNAME']
+    url_base_pathname=server.config['URL_BASE_PATHNAME'],
+    # responses are compressed by install_compression below instead
+    compress=False,
 )
 
 # We need to suppress validations as we will be initialising callbacks
 # that target element IDs that won't yet occur in the layout. 
 app.config.supress_callback_exceptions = True
 
+# Time a sample of callbacks and page loads, served at /metrics. Installed
+# first, so the time and size of compressing responses are counted too.
+install_metrics(server, app, sample_rate=server.config['METRICS_SAMPLE_RATE'])
+
+# Send precompressed static files and compress large responses, like Dash
+# layout and callback JSON, for clients that accept it
+install_compression(server, min_size=server.config['COMPRESS_MIN_SIZE'])
+
 
 @server.route('/favicon.ico')
 def favicon():
@@ -38,6 +50,24 @@ def favicon():
     )
 
 
+@server.after_request
+def cache_static_forever(response):
+    """Let browsers cache static files requested by the URLs of
+    `app.get_static_url` for STATIC_MAX_AGE seconds, since those URLs change
+    whenever the files do
+    """
+    if (request.endpoint == 'static' and 'v' in request.args
+            and response.status_code in (200, 304)):
+        path = app.get_static_path(request.view_args['filename'])
+        if os.path.isfile(path) and request.args['v'] == get_file_hash(path):
+            response.headers['Cache-Control'] = (
+                f"public, max-age={server.config['STATIC_MAX_AGE']}, "
+                "immutable"
+            )
+            response.headers.pop('Expires', None)
+    return response
+
+
 @server.errorhandler(HaltCallback)
 def handle_error(error):
     """Handle a halted callback and return an empty 204 response"""
@@ -53,3 +53,16 @@ STATIC_FOLDER = 'static'
 
 # The URL your static files will be mounted at 
 STATIC_URL_PATH = '/static'
+
+# Seconds browsers may cache static files for when they're requested by a URL
+# with the hash of their contents, like the style sheets in the index
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+# Responses of at least this many bytes are compressed for clients that accept
+# it. Static files are sent compressed if they've been precompressed with
+# `python -m dashboard.compression dashboard/static`.
+COMPRESS_MIN_SIZE = 1024
+
+# Fraction of requests timed for the latency quantiles served at /metrics.
+# Every request is counted either way.
+METRICS_SAMPLE_RATE = 0.1
@@ -0,0 +1,37 @@
+import dash_html_components as html
+
+from .cache import ResultStore
+
+
+class TableRenderer:
+    """Renders dataframes as html tables with the first column as row
+    headers. Cells are read from the frame's column arrays rather than
+    indexed one at a time, and each row component is built once and reused
+    whenever the same row (same columns and values) appears in a later
+    table, so reordering or filtering a table only builds the new rows.
+    """
+
+    def __init__(self, className='table table-striped', max_rows=4096):
+        self.className = className
+        self.rows = ResultStore(max_size=max_rows, ttl=float('inf'))
+
+    def render(self, df):
+        columns = list(df.columns)
+        header = html.Thead(
+            html.Tr([html.Th(col, scope='col') for col in columns])
+        )
+        rows = []
+        for values in zip(*[df[col].values.tolist() for col in columns]):
+            key = (tuple(columns), values)
+            row = self.rows.get(key)
+            if row is None:
+                row = self.render_row(values)
+                self.rows.set(key, row)
+            rows.append(row)
+        body = html.Tbody(rows)
+        return html.Table([header, body], className=self.className)
+
+    def render_row(self, values):
+        cells = [html.Th(values[0], scope='row')]
+        cells.extend(html.Td(value) for value in values[1:])
+        return html.Tr(cells)
@@ -22,21 +22,48 @@ with warnings.catch_warnings():
     import pandas as pd
 from dash.dependencies import Input, State, Output, Event
 from dotenv import load_dotenv
+from flask import jsonify
+from flask import request
 from plotly.colors import DEFAULT_PLOTLY_COLORS
+import glob
+import json
 import numpy as np
 import os
+import tempfile
 
+from dashboard.cache import DiskCache
+from dashboard.cache import ResultStore
+from dashboard.cache import make_key
+from dashboard.cache import memoize
 from dashboard.components import Col
 from dashboard.components import Container
 from dashboard.components import Row
+from dashboard.compression import install_compression
+from dashboard.data import find_summary_file
+from dashboard.data import load_summary
+from dashboard.figures import PositionTraces
+from dashboard.metrics import install_metrics
+from dashboard.query import QueryIndex
+from dashboard.search import PlayerSearchIndex
+from dashboard.tables import TableRenderer
 
 
 load_dotenv()
 DEBUG=(os.getenv('DEBUG') == 'True')
 
-app = dash.Dash(__name__)
+app = dash.Dash(__name__, compress=False)
 app.title = 'Dash Skeleton'
 server = app.server
+# Time a sample of callbacks and page loads, served at /metrics. Installed
+# first, so the time and size of compressing responses are counted too.
+METRICS = install_metrics(
+    server, app, sample_rate=float(os.getenv('METRICS_SAMPLE_RATE', '0.1'))
+)
+# Compress large responses, like the layout and callback JSON, for clients
+# that accept it, instead of Dash compressing every response
+install_compression(
+    server, min_size=int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+)
 my_css_url = "https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css"
 app.css.append_css({"external_url": my_css_url})
 BOOTSTRAP_SCREEN_SIZE='lg'
@@ -49,43 +76,202 @@ ROOT_PATH = './'
 # If you need to run your app locally
 #app.scripts.config.serve_locally = True
 
-scores_summary_csv_path = os.path.join(
-    ROOT_PATH, 'data/processed/scores-summary_2017-to-2017.csv'
+# Load the summary in compact dtypes (categorical teams and positions, float32
+# weekly scores, int32 player ids). With SUMMARY_MMAP (the default), its
+# columns are memory-mapped from a binary copy next to the summary file, so
+# gunicorn workers share one copy of the data instead of loading their own.
+SUMMARY_MMAP = (os.getenv('SUMMARY_MMAP', 'True') == 'True')
+scores_summary_path = os.path.join(
+    ROOT_PATH, 'data/processed/scores-summary_2017-to-2017'
+)
+scores_summary_file = find_summary_file(scores_summary_path)
+FULL_DF = load_summary(scores_summary_file, mmap=SUMMARY_MMAP)
+# Presorted rows and a player id hash index, so the table doesn't need to
+# sort, group or copy FULL_DF for every change to the controls. Players can
+# also be ranked by their floor and ceiling, a weekly average minus and plus
+# one standard deviation.
+QUERY_INDEX = QueryIndex(FULL_DF, 'week_avg', metrics={
+    'floor': FULL_DF['week_avg'].values - FULL_DF['week_std'].values,
+    'ceiling': FULL_DF['week_avg'].values + FULL_DF['week_std'].values,
+})
+
+# Tables and callback outputs are memoized in a bounded LRU in each worker
+# process and shared between gunicorn workers through a disk cache in
+# SHARED_CACHE_DIR (set it to an empty string to only cache per process),
+# which defaults to a private directory of this user. If it isn't private,
+# results are only cached per process. Cached results are only valid for this
+# summary file and this version of the app and dashboard modules, so they're
+# all part of every cache key.
+RESULT_STORE_SIZE = int(os.getenv('RESULT_STORE_SIZE', '128'))
+RESULT_STORE_TTL = float(os.getenv('RESULT_STORE_TTL', '600'))
+SHARED_CACHE_DIR = os.getenv(
+    'SHARED_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), f'nfl-dash-cache-{os.geteuid()}')
 )
-FULL_DF = pd.read_csv(scores_summary_csv_path).fillna(0)
+SHARED_CACHE = None
+if SHARED_CACHE_DIR:
+    try:
+        SHARED_CACHE = DiskCache(SHARED_CACHE_DIR, ttl=RESULT_STORE_TTL)
+    except PermissionError as e:
+        warnings.warn(f'Not sharing cached results between processes: {e}')
+CACHE_VERSION = make_key({
+    'files': [
+        [path, os.path.getmtime(path), os.path.getsize(path)]
+        for path in [scores_summary_file, __file__] + sorted(glob.glob(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'dashboard', '*.py')
+        ))
+    ],
+})
+# Rendered table rows, reused across tables that share players
+TABLE_RENDERER = TableRenderer()
+
+
+def memoize_callback(normalize=None):
+    return memoize(
+        store=ResultStore(RESULT_STORE_SIZE, RESULT_STORE_TTL),
+        shared=SHARED_CACHE,
+        normalize=normalize,
+        namespace=CACHE_VERSION,
+    )
+
+
+def get_query_params(positions, num_rows, per_position, drafted_players,
+                     rank_by='week_avg'):
+    """Returns the arguments of `get_updated_df` in a canonical form, so that
+    equivalent queries (e.g. the same players drafted in a different order)
+    share cached results. Players are ranked by weekly average unless
+    `rank_by` is one of RANK_METRICS.
+    """
+    return {
+        'positions': sorted(positions or []),
+        'num_rows': num_rows,
+        'per_position': bool(per_position),
+        'drafted_players': sorted(set(drafted_players or []), key=str),
+        'rank_by': rank_by if rank_by in dict(RANK_METRICS) else 'week_avg',
+    }
+
+
 ALL_POSITIONS = ['QB', 'RB', 'WR', 'TE', 'K', 'DEFENSE']
 POSITION_COLORS = {p: c for p, c in zip(ALL_POSITIONS, DEFAULT_PLOTLY_COLORS)}
+TABLE_COLUMNS = [
+    'player', 'team', 'position', 'season_total', 'week_avg', 'week_std'
+]
+# Metrics to pick the best players by, with their labels
+RANK_METRICS = [
+    ('week_avg', 'Weekly Avg.'),
+    ('season_total', 'Season Total'),
+    ('week_std', 'Weekly Std.'),
+    ('floor', 'Floor (Avg. - Std.)'),
+    ('ceiling', 'Ceiling (Avg. + Std.)'),
+]
+# Number of players per page of the table; 0 shows every player on one page
+PAGE_SIZES = [25, 50, 100, 0]
+
+
+def get_player_label(player, team, position):
+    if position == 'DEFENSE':
+        return player
+    return f'{player} ({team} {position})'
+
+
+# The drafted players dropdown only gets the options that match what's typed
+# in the player search box, rather than every player in the layout
+PLAYER_IDS = FULL_DF['player_id'].tolist()
+PLAYER_LABELS = [
+    get_player_label(p, t, pos) for p, t, pos in zip(
+        FULL_DF['player'], FULL_DF['team'], FULL_DF['position'],
+    )
+]
+# Graph traces for each position, prebuilt from the rounded values shown in the
+# graphs. Each player gets a fixed horizontal jitter in the position graph,
+# drawn from a seeded generator by player id, so the same query always gives
+# the same figure and figures can be cached.
+player_ids = FULL_DF['player_id'].values
+JITTER = np.random.RandomState(0).uniform(
+    -0.2, 0.2, player_ids.max() + 1 if len(player_ids) else 0
+)[player_ids]
+POSITION_TRACES = PositionTraces(QUERY_INDEX, {
+    'week_avg': FULL_DF['week_avg'].round(1).values,
+    'week_std': FULL_DF['week_std'].round(1).values,
+    'player': FULL_DF['player'].values,
+    'position_x': (
+        pd.Index(ALL_POSITIONS).get_indexer(FULL_DF['position']) + JITTER
+    ),
+}, POSITION_COLORS)
+GRAPH_1_LAYOUT = {
+    'title': '2017 Weekly Avg. vs Std.',
+    'height': '400',
+    'font': {'size': 14},
+    'hovermode': 'closest',
+    'xaxis': {'title': 'Weekly Std.'},
+    'yaxis': {'title': 'Weely Avg.'},
+}
+GRAPH_2_LAYOUT = {
+    'title': '2017 Weekly Avg. vs Position',
+    'height': '400',
+    'font': {'size': 14},
+    'hovermode': 'closest',
+    'xaxis': {
+        'title': 'Position',
+        'tickvals': [i for i, _ in enumerate(ALL_POSITIONS)],
+        'ticktext': ALL_POSITIONS,
+    },
+    'yaxis': {'title': 'Weely Avg.'},
+}
+SEARCH_INDEX = PlayerSearchIndex(FULL_DF['player'], QUERY_INDEX.rank)
+SEARCH_RESULTS = int(os.getenv('PLAYER_SEARCH_RESULTS', '20'))
+MAX_SEARCH_RESULTS = 100
+
+
+def get_player_options(rows):
+    return [{'label': PLAYER_LABELS[row], 'value': PLAYER_IDS[row]}
+            for row in rows]
 
 
-def get_updated_df(positions=ALL_POSITIONS, num_rows=20, per_position=True, drafted_players=None):
-    df = FULL_DF.copy()
-    df = df[df['position'].isin(positions)].copy()
-    if drafted_players is not None:
-        df = df[~df['player'].isin(drafted_players)].copy()
-    columns = [
-        'player', 'team', 'position', 'season_total', 'week_avg', 'week_std'
-    ]
-    if per_position:
-        # Get num_rows rows per position
-        df = (
-            df.sort_values('week_avg', ascending=False)
-            .groupby('position')
-            .apply(lambda group: group.iloc[:num_rows, :])
-            .sort_values('week_avg', ascending=False)
-        )
-        # Get rid of annoying multilevel index after groupby/apply
-        df.index = df.index.droplevel()
-    else:
-        # Get a total of num_rows rows
-        df = (
-            df.iloc[:num_rows, :]
-            .sort_values('week_avg', ascending=False)
-            .copy()
-        )
+@server.route('/api/players')
+def search_players():
+    """Returns the dropdown options of the best `k` players matching the
+    query `q` as JSON
+    """
+    query = request.args.get('q', '')
+    k = request.args.get('k', SEARCH_RESULTS, type=int)
+    rows = SEARCH_INDEX.search(query, min(max(k, 0), MAX_SEARCH_RESULTS))
+    return jsonify(get_player_options(rows))
+
+
+@memoize_callback(normalize=get_query_params)
+def get_updated_df(positions=ALL_POSITIONS, num_rows=20, per_position=True,
+                   drafted_players=None, rank_by='week_avg'):
+    df = QUERY_INDEX.top(positions, num_rows, per_position, drafted_players,
+                         columns=TABLE_COLUMNS, metric=rank_by)
     numerical_columns = ['season_total', 'week_avg', 'week_std']
-    df = df[columns].copy()
-    df.loc[:, numerical_columns] = df[numerical_columns].round(1)
-    return df
+    return df.round({column: 1 for column in numerical_columns})
+
+
+# The callbacks' caches are reported at /metrics by callback id, and the
+# shared table cache they all read from is reported under its own name
+METRICS.watch_cache('get_updated_df', get_updated_df.cache_counts)
+
+
+def get_page_count(num_rows, page_size):
+    if not page_size:
+        return 1
+    return max(1, -(-num_rows // page_size))
+
+
+def get_page(df, sort_column, ascending, page, page_size):
+    """Returns page `page` (counting from 1) of `df`, a result of
+    `get_updated_df`, sorted by `sort_column`. The rows are picked out of the
+    query index's presorted order of all players rather than sorting `df`.
+    Pages past the last one show the last page.
+    """
+    rows = QUERY_INDEX.sort_rows(df.index.values, sort_column, ascending)
+    if page_size:
+        page_count = get_page_count(len(rows), page_size)
+        page = min(max(int(page or 1), 1), page_count)
+        rows = rows[(page - 1) * page_size:page * page_size]
+    return df.loc[rows]
 
 
 app.layout = Container([
@@ -126,21 +312,74 @@ app.layout = Container([
                         value='per-position',
                         labelStyle={'margin': '5px'},
                     ),
+                    html.Label('Rank Players By', style={'margin': '5px'}),
+                    dcc.Dropdown(
+                        id='rank-by-dropdown',
+                        options=[
+                            {'label': label, 'value': metric}
+                            for metric, label in RANK_METRICS
+                        ],
+                        value='week_avg',
+                        clearable=False,
+                    ),
                     html.Label(
                         'Drafted/Unavailable Players:',
                         style={'margin': '5px'}
                     ),
+                    dcc.Input(
+                        id='player-search-input',
+                        type='text',
+                        placeholder='Search players',
+                        style={'margin': '5px'},
+                    ),
                     dcc.Dropdown(
                         id='drafted-players-dropdown',
-                        options=[
-                            {'label': p, 'value': p} for p in FULL_DF['player']
-                        ],
+                        options=[],
                         multi=True,
                         clearable=False,
                     )
                 ], bp=BOOTSTRAP_SCREEN_SIZE, size=12,
                 )
             ]),
+            Row([
+                Col([
+                    html.Label('Sort By', style={'margin': '5px'}),
+                    dcc.Dropdown(
+                        id='sort-dropdown',
+                        options=[
+                            {'label': c, 'value': c} for c in TABLE_COLUMNS
+                        ],
+                        value='week_avg',
+                        clearable=False,
+                    ),
+                    dcc.RadioItems(
+                        id='sort-direction-radioitems',
+                        options=[
+                            {'label': 'Descending', 'value': 'desc'},
+                            {'label': 'Ascending', 'value': 'asc'},
+                        ],
+                        value='desc',
+                        labelStyle={'margin': '5px'},
+                    ),
+                ], bp=BOOTSTRAP_SCREEN_SIZE, size=6,
+                ),
+                Col([
+                    html.Label('Players Per Page', style={'margin': '5px'}),
+                    dcc.Dropdown(
+                        id='page-size-dropdown',
+                        options=[
+                            {'label': str(size) if size else 'All',
+                             'value': size} for size in PAGE_SIZES
+                        ],
+                        value=50,
+                        clearable=False,
+                    ),
+                    html.Label('Page', style={'margin': '5px'}),
+                    dcc.Input(id='page-input', type='number', value=1, min=1),
+                    html.Span(id='page-count', style={'margin': '5px'}),
+                ], bp=BOOTSTRAP_SCREEN_SIZE, size=6,
+                ),
+            ]),
             Col(
                 id='table',
                 bp=BOOTSTRAP_SCREEN_SIZE,
@@ -158,64 +397,96 @@ app.layout = Container([
         Input('nrows-input', 'value'),
         Input('count-method-radioitems', 'value'),
         Input('drafted-players-dropdown', 'value'),
+        Input('rank-by-dropdown', 'value'),
+    ],
+)
+def hidden_data_callback(positions, num_rows, count_method, drafted_players,
+                         rank_by):
+    params = get_query_params(positions, num_rows,
+                              count_method == 'per-position', drafted_players,
+                              rank_by)
+    # build the table now so the output callbacks find it in the cache
+    get_updated_df(**params)
+    return json.dumps({'key': make_key(params), 'params': params})
+
+
+@app.callback(
+    Output('drafted-players-dropdown', 'options'),
+    [Input('player-search-input', 'value')],
+    [State('drafted-players-dropdown', 'value')],
+)
+def drafted_players_options_callback(query, drafted_players):
+    """Returns the options of the players already selected, so they keep
+    their labels, followed by the best players matching `query`
+    """
+    selected = QUERY_INDEX.player_rows.get_indexer(drafted_players or [])
+    selected = selected[selected >= 0]
+    matches = SEARCH_INDEX.search(query, SEARCH_RESULTS)
+    matches = matches[~np.isin(matches, selected)]
+    return get_player_options(np.concatenate([selected, matches]))
+
+
+def get_result(hidden_data):
+    """Returns the table the hidden-data div refers to, from the cache if
+    it's there and rebuilt from its query parameters otherwise. The
+    parameters come from the client, so they're checked again.
+    """
+    params = json.loads(hidden_data)['params']
+    return get_updated_df(**get_query_params(**params))
+
+
+@app.callback(
+    Output('page-input', 'value'),
+    [
+        Input('hidden-data', 'children'),
+        Input('sort-dropdown', 'value'),
+        Input('sort-direction-radioitems', 'value'),
+        Input('page-size-dropdown', 'value'),
+    ],
+)
+def page_reset_callback(hidden_data, sort_column, sort_direction, page_size):
+    return 1
+
+
+@app.callback(
+    Output('page-count', 'children'),
+    [
+        Input('hidden-data', 'children'),
+        Input('page-size-dropdown', 'value'),
     ],
 )
-def hidden_data_callback(positions, num_rows, count_method, drafted_players):
-    if count_method == 'per-position':
-        per_position = True
-    else:
-        per_position = False
-    df = get_updated_df(positions, num_rows, per_position, drafted_players)
-    return df.to_json(orient='split')
+def page_count_callback(hidden_data, page_size):
+    num_rows = len(get_result(hidden_data))
+    return f'of {get_page_count(num_rows, page_size)}'
 
 
 @app.callback(
     Output('table', 'children'),
-    [Input('hidden-data', 'children')],
+    [
+        Input('hidden-data', 'children'),
+        Input('sort-dropdown', 'value'),
+        Input('sort-direction-radioitems', 'value'),
+        Input('page-input', 'value'),
+        Input('page-size-dropdown', 'value'),
+    ],
 )
-def table_callback(jsonified_cleaned_data):
-    df = pd.read_json(jsonified_cleaned_data, orient='split')
-    header = html.Thead(
-        html.Tr([html.Th(col, scope='col') for col in df.columns])
-    )
-    rows = []
-    for i in range(len(df)):
-        cells = []
-        for j, col in enumerate(df.columns):
-            if j == 0:
-                cells.append(html.Th(df.iloc[i][col], scope='row'))
-            else:
-                cells.append(html.Td(df.iloc[i][col]))
-        rows.append(html.Tr(cells))
-    body = html.Tbody(rows)
-    return html.Table([header, body], className='table table-striped')
+@memoize_callback()
+def table_callback(hidden_data, sort_column, sort_direction, page, page_size):
+    df = get_page(get_result(hidden_data), sort_column,
+                  sort_direction == 'asc', page, page_size)
+    return TABLE_RENDERER.render(df)
 
 @app.callback(
     Output('graph_1', 'figure'),
     [Input('hidden-data', 'children')],
 )
-def graph_1_callback(jsonified_cleaned_data):
-    df = pd.read_json(jsonified_cleaned_data, orient='split')
+@memoize_callback()
+def graph_1_callback(hidden_data):
+    rows = get_result(hidden_data).index.values
     return {
-        'data': [
-            {
-                'x': sub_df['week_std'],
-                'y': sub_df['week_avg'],
-                'type': 'scatter',
-                'name': position,
-                'mode': 'markers',
-                'text': sub_df['player'],
-                'marker': {'size': 10, 'color': POSITION_COLORS[position]},
-            } for position, sub_df in df.groupby('position')
-        ],
-        'layout': {
-            'title': '2017 Weekly Avg. vs Std.',
-            'height': '400',
-            'font': {'size': 14},
-            'hovermode': 'closest',
-            'xaxis': {'title': 'Weekly Std.'},
-            'yaxis': {'title': 'Weely Avg.'},
-        },
+        'data': POSITION_TRACES.get_traces(rows, 'week_std', 'week_avg',
+                                           'player'),
+        'layout': GRAPH_1_LAYOUT,
     }
 
 
@@ -223,35 +494,13 @@ def graph_1_callback(jsonified_cleaned_data):
     Output('graph_2', 'figure'),
     [Input('hidden-data', 'children')],
 )
-def graph_2_callback(jsonified_cleaned_data):
-    df = pd.read_json(jsonified_cleaned_data, orient='split')
+@memoize_callback()
+def graph_2_callback(hidden_data):
+    rows = get_result(hidden_data).index.values
     return {
-        'data': [
-            {
-                'x': (
-                    ALL_POSITIONS.index(position) +
-                    np.random.uniform(-0.2,0.2,len(sub_df))
-                ),
-                'y': sub_df['week_avg'],
-                'type': 'scatter',
-                'name': position,
-                'mode': 'markers',
-                'text': sub_df['player'],
-                'marker': {'size': 10, 'color': POSITION_COLORS[position]},
-            } for position, sub_df in df.groupby('position')
-        ],
-        'layout': {
-            'title': '2017 Weekly Avg. vs Position',
-            'height': '400',
-            'font': {'size': 14},
-            'hovermode': 'closest',
-            'xaxis': {
-                'title': 'Position',
-                'tickvals': [i for i, _ in enumerate(ALL_POSITIONS)],
-                'ticktext': ALL_POSITIONS,
-            },
-            'yaxis': {'title': 'Weely Avg.'},
-        },
+        'data': POSITION_TRACES.get_traces(rows, 'position_x', 'week_avg',
+                                           'player'),
+        'layout': GRAPH_2_LAYOUT,
     }
 
 
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# benchmark_scoring.py
+#
+# Copyright (c) 2018 Ben Lindsay <benjlindsay@gmail.com>
+
+from pathlib2 import Path
+import click
+import logging
+import timeit
+import warnings
+with warnings.catch_warnings():
+    # ignore warnings that are safe to ignore according to
+    # https://github.com/ContinuumIO/anaconda-issues/issues/6678
+    # #issuecomment-337276215
+    warnings.simplefilter("ignore")
+    import pandas as pd
+
+from src.scoring import calc_scores
+from src.scoring import get_player_scoring_dict
+from src.scoring import get_team_scoring_dict
+
+
+def calc_scores_apply(stats_df, team_scoring_dict, player_scoring_dict):
+    """The original element-by-element implementation of `calc_scores`, kept
+    as a reference for correctness and speed
+    """
+    scores_df = stats_df.copy().fillna(0)
+    first_columns = ['season', 'week', 'team', 'position', 'player']
+    if 'gsis_id' in scores_df.columns:
+        first_columns.append('gsis_id')
+    team_columns = [c for c in scores_df.columns if c.startswith('team_')]
+    player_columns = [c for c in scores_df.columns
+                      if c not in first_columns and c not in team_columns]
+    team_score_columns = [c + '_score' for c in team_columns]
+    player_score_columns = [c + '_score' for c in player_columns]
+    final_columns_order = (
+        first_columns + team_columns + player_columns + team_score_columns +
+        player_score_columns + ['total_score']
+    )
+    for stat in team_scoring_dict:
+        defense_rows = (scores_df['position'] == 'DEFENSE')
+        if stat in scores_df.columns:
+            scores_df.loc[defense_rows, stat + '_score'] = (
+                scores_df.loc[defense_rows, stat].apply(
+                    team_scoring_dict[stat]
+                )
+            )
+    for stat in player_scoring_dict:
+        player_rows = (scores_df['position'] != 'DEFENSE')
+        if stat in scores_df.columns:
+            scores_df.loc[player_rows, stat + '_score'] = (
+                scores_df.loc[player_rows, stat].apply(
+                    player_scoring_dict[stat]
+                )
+            )
+    scores_df['total_score'] = (
+        scores_df[team_score_columns + player_score_columns].sum(axis=1)
+    )
+    scores_df = scores_df[final_columns_order]
+    scores_df['week'] = scores_df['week'].astype(int)
+    return scores_df
+
+
+@click.command()
+@click.argument('season', type=click.INT)
+@click.argument('scoring_method', type=click.STRING)
+@click.option('--copies', default=9, type=click.INT,
+              help='Number of copies of the season to score, e.g. 9 for '
+                   '2009-2017')
+@click.option('--repeat', default=3, type=click.INT,
+              help='Number of timing runs to take the best of')
+def main(season=2017, scoring_method='nfl.com', copies=9, repeat=3):
+    """Check that `calc_scores` matches the original `Series.apply` scoring on
+    <project_dir>/data/raw/<season> and time both implementations
+    """
+    logger = logging.getLogger(__name__)
+    project_dir = Path(__file__).resolve().parents[1]
+    season_dir = project_dir / 'data' / 'raw' / str(season)
+    df_list = []
+    for csv_file in sorted(season_dir.glob('*.csv')):
+        df = pd.read_csv(str(csv_file))
+        df['season'] = season
+        df_list.append(df)
+    stats_df = pd.concat(df_list * copies, sort=False).reset_index(drop=True)
+    team_scoring_dict = get_team_scoring_dict()
+    player_scoring_dict = get_player_scoring_dict(method=scoring_method)
+    args = (stats_df, team_scoring_dict, player_scoring_dict)
+
+    pd.testing.assert_frame_equal(calc_scores(*args),
+                                  calc_scores_apply(*args))
+    logger.info('scores match on {} rows'.format(len(stats_df)))
+
+    apply_time = min(timeit.repeat(lambda: calc_scores_apply(*args),
+                                   number=1, repeat=repeat))
+    vectorized_time = min(timeit.repeat(lambda: calc_scores(*args),
+                                        number=1, repeat=repeat))
+    logger.info('Series.apply: {:.3f} s'.format(apply_time))
+    logger.info('vectorized:   {:.3f} s'.format(vectorized_time))
+    logger.info('speedup:      {:.1f}x'.format(apply_time / vectorized_time))
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -9,6 +9,7 @@ from dotenv import find_dotenv, load_dotenv
 from pathlib2 import Path
 import click
 import logging
+import numpy as np
 import warnings
 with warnings.catch_warnings():
     # ignore warnings that are safe to ignore according to
@@ -17,52 +18,302 @@ with warnings.catch_warnings():
     warnings.simplefilter("ignore")
     import pandas as pd
 
-from src.scoring import calc_scores
-from src.scoring import get_player_scoring_dict
-from src.scoring import get_team_scoring_dict
+from src.data.players import PlayerRegistry
+from src.data.storage import get_partitions
+from src.data.storage import read_raw_stats
+from src.data.storage import write_summary
+from src.scoring import load_ruleset
+from src.scoring import score_rulesets
 
 
 @click.command()
 @click.argument('from_season', type=click.INT)
 @click.argument('to_season', type=click.INT)
-@click.argument('scoring_method', type=click.STRING)
-def main(from_season=2009, to_season=2017, scoring_method='nfl.com'):
+@click.argument('scoring_methods', type=click.STRING, nargs=-1, required=True)
+@click.option('--summary-format', default='both',
+              type=click.Choice(['csv', 'parquet', 'both']),
+              help='File format(s) of the score summaries')
+@click.option('--streaming', is_flag=True,
+              help='Read and score one week at a time instead of loading '
+                   'every season at once, to keep memory use low')
+def main(from_season=2009, to_season=2017, scoring_methods=('nfl.com',),
+         summary_format='both', streaming=False):
     """Combine and score data in <project_dir>/data/raw and output to
-    <project_dir>/data/processed/scored-data.csv
+    <project_dir>/data/processed/scores-summary_<from>-to-<to>.csv. Each of
+    `scoring_methods` is the name of a ruleset in src/rulesets or the path to
+    a ruleset file. The raw data is read and scored once for all rulesets. If
+    more than one ruleset is given, each summary is written to
+    scores-summary_<ruleset name>_<from>-to-<to>.csv instead.
+
+    Seasons that have been imported into the parquet raw stats dataset in
+    <project_dir>/data/interim/raw-stats are read from there instead of from
+    the csv files. Summaries are written as csv, as typed parquet files with
+    the same name and a .parquet extension, or both.
+
+    With --streaming, the raw stats are read and scored one week at a time
+    and folded into running per-player statistics, so memory use doesn't grow
+    with the number of seasons. The summaries are the same either way.
+
+    Players are identified by the integer ids of the player registry in
+    <project_dir>/data/processed/player-registry.csv (see src/data/players.py),
+    which is updated with any new players. Summaries are indexed by
+    `player_id`.
     """
     logger = logging.getLogger(__name__)
     logger.info('making final data set from raw data')
     project_dir = Path(__file__).resolve().parents[2]
-    scores_csv_path = (
-        project_dir / 'data' / 'processed' /
-        'scores-summary_{}-to-{}.csv'.format(from_season, to_season)
-    )
+    processed_dir = project_dir / 'data' / 'processed'
     raw_dir = project_dir / 'data' / 'raw'
-    df_list = []
+    dataset_dir = project_dir / 'data' / 'interim' / 'raw-stats'
+    rulesets = [load_ruleset(method) for method in scoring_methods]
+    registry = PlayerRegistry(processed_dir / 'player-registry.csv')
+    if streaming:
+        summaries = get_streaming_summaries(from_season, to_season, raw_dir,
+                                            dataset_dir, rulesets, registry)
+    else:
+        summaries = get_summaries(from_season, to_season, raw_dir,
+                                  dataset_dir, rulesets, registry)
+    registry.save()
+    for ruleset, summary_df in zip(rulesets, summaries):
+        if len(rulesets) == 1:
+            filename = 'scores-summary_{}-to-{}'.format(from_season,
+                                                        to_season)
+        else:
+            filename = 'scores-summary_{}_{}-to-{}'.format(
+                ruleset['name'], from_season, to_season
+            )
+        logger.info('writing {}'.format(filename))
+        if summary_format in ['csv', 'both']:
+            summary_df.to_csv(str(processed_dir / (filename + '.csv')))
+        if summary_format in ['parquet', 'both']:
+            write_summary(summary_df, processed_dir / (filename + '.parquet'))
+
+
+def iter_raw_weeks(from_season, to_season, raw_dir, dataset_dir):
+    """Yields a `(season, week, df)` tuple with a dataframe of the raw stats
+    of each week of every season from `from_season` to `to_season`, read from
+    the week's partition of the parquet dataset in `dataset_dir` if it has
+    one and from the week's csv file in `raw_dir` otherwise
+    """
     for season_year in range(from_season, to_season + 1):
+        week_sources = {}
         season_dir = raw_dir / str(season_year)
         for csv_file in season_dir.glob('*.csv'):
-            df = pd.read_csv(str(csv_file))
-            df['season'] = season_year
-            df_list.append(df)
-    full_df = pd.concat(df_list, sort=False).reset_index(drop=True)
-    team_scoring_dict = get_team_scoring_dict()
-    player_scoring_dict = get_player_scoring_dict(method=scoring_method)
-    full_df = calc_scores(full_df, team_scoring_dict, player_scoring_dict)
-    full_df['week'] = full_df[['season', 'week']].apply(
-        lambda x: '{}-{:02d}'.format(x[0], x[1]), axis=1
+            week_sources[int(csv_file.stem.split('-')[-1])] = csv_file
+        for _, week, _ in get_partitions(dataset_dir, seasons=[season_year]):
+            week_sources[week] = None
+        for week, csv_file in sorted(week_sources.items()):
+            if csv_file is None:
+                df = read_raw_stats(dataset_dir, seasons=[season_year],
+                                    weeks=[week])
+            else:
+                df = pd.read_csv(str(csv_file))
+                df['season'] = season_year
+            yield season_year, week, df
+
+
+def load_raw_stats(from_season, to_season, raw_dir, dataset_dir):
+    """Returns a dataframe of the raw stats of every season from
+    `from_season` to `to_season` (see `iter_raw_weeks`)
+    """
+    df_list = [df for _, _, df in iter_raw_weeks(from_season, to_season,
+                                                 raw_dir, dataset_dir)]
+    return pd.concat(df_list, sort=False).reset_index(drop=True)
+
+
+def get_summaries(from_season, to_season, raw_dir, dataset_dir, rulesets,
+                  registry):
+    """Returns a list with the score summary of each of `rulesets`, made by
+    loading and scoring the raw stats of every season at once. Player ids come
+    from the PlayerRegistry `registry`.
+    """
+    full_df = load_raw_stats(from_season, to_season, raw_dir,
+                             dataset_dir).fillna(0)
+    full_df['player_id'] = registry.get_ids(full_df)
+    scores_df = score_rulesets(full_df, rulesets)
+    return [get_summary_df(full_df, scores_df[ruleset['name']])
+            for ruleset in rulesets]
+
+
+def get_streaming_summaries(from_season, to_season, raw_dir, dataset_dir,
+                            rulesets, registry):
+    """Returns a list with the score summary of each of `rulesets`, made by
+    reading and scoring the raw stats one week at a time. Player ids come from
+    the PlayerRegistry `registry`.
+    """
+    accumulators = [SummaryAccumulator() for _ in rulesets]
+    for season, week, week_df in iter_raw_weeks(from_season, to_season,
+                                                raw_dir, dataset_dir):
+        week_df = week_df.fillna(0)
+        week_df['player_id'] = registry.get_ids(week_df)
+        scores_df = score_rulesets(week_df, rulesets)
+        for ruleset, accumulator in zip(rulesets, accumulators):
+            accumulator.add_week(season, week, week_df,
+                                 scores_df[ruleset['name']])
+    return [accumulator.get_summary_df() for accumulator in accumulators]
+
+
+class SummaryAccumulator(object):
+    """Builds a score summary like `get_summary_df` one week at a time.
+
+    Each week only updates the count, sum and Welford running mean and sum of
+    squared deviations of the players who played in it. The zeros of the
+    weeks a player missed are merged into those statistics once, at the end,
+    so the season total, weekly average and weekly standard deviation are
+    exact. Apart from these per-player arrays, only each week's nonzero
+    player scores are kept, for the week columns of the summary.
+    """
+
+    def __init__(self):
+        self.player_codes = {}
+        self.player_ids = []
+        self.players = []
+        self.teams = []
+        self.positions = []
+        self.week_keys = []
+        self.week_scores = []
+        self.n_collisions = 0
+        self.count = np.zeros(0)
+        self.total = np.zeros(0)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+
+    def add_week(self, season, week, week_df, total_score):
+        """Adds the total scores `total_score` of the rows of `week_df`, the
+        raw stats of one week
+        """
+        codes = self._get_player_codes(week_df)
+        n_players = len(self.player_ids)
+        for name in ['count', 'total', 'mean', 'm2']:
+            values = getattr(self, name)
+            setattr(self, name, np.append(values,
+                                          np.zeros(n_players - len(values))))
+        row_counts = np.bincount(codes, minlength=n_players)
+        self.n_collisions += np.count_nonzero(row_counts > 1)
+        played = np.flatnonzero(row_counts)
+        scores = np.bincount(codes, weights=np.asarray(total_score, float),
+                             minlength=n_players)[played]
+        self.count[played] += 1
+        delta = scores - self.mean[played]
+        self.mean[played] += delta / self.count[played]
+        self.m2[played] += delta * (scores - self.mean[played])
+        self.total[played] += scores
+        self.week_keys.append(season * 100 + week)
+        nonzero = scores != 0
+        self.week_scores.append((played[nonzero], scores[nonzero]))
+
+    def _get_player_codes(self, week_df):
+        """Returns the code of the player of each row of `week_df`, adding
+        players that haven't been seen before along with their name, team and
+        position
+        """
+        week_codes, player_ids = pd.factorize(week_df['player_id'])
+        _, first_rows = np.unique(week_codes, return_index=True)
+        for player_id, row in zip(player_ids, first_rows):
+            if player_id not in self.player_codes:
+                self.player_codes[player_id] = len(self.player_ids)
+                self.player_ids.append(player_id)
+                self.players.append(week_df['player'].values[row])
+                self.teams.append(week_df['team'].values[row])
+                self.positions.append(week_df['position'].values[row])
+        codes = np.array([self.player_codes[player_id]
+                          for player_id in player_ids], dtype=np.int64)
+        return codes[week_codes]
+
+    def get_summary_df(self):
+        log_collisions(self.n_collisions)
+        n_weeks = len(self.week_keys)
+        week_order = np.argsort(self.week_keys, kind='mergesort')
+        scores = np.zeros((len(self.player_ids), n_weeks))
+        for j, i in enumerate(week_order):
+            codes, values = self.week_scores[i]
+            scores[codes, j] = values
+        # merge each player's stats with those of the weeks they missed,
+        # which have a mean and sum of squared deviations of 0 (Chan et al.)
+        missed = n_weeks - self.count
+        week_avg = self.mean * self.count / n_weeks
+        m2 = self.m2 + self.mean ** 2 * self.count * missed / n_weeks
+        if n_weeks > 1:
+            week_std = np.sqrt(m2 / (n_weeks - 1))
+        else:
+            week_std = np.full(len(self.player_ids), np.nan)
+        return make_summary_df(
+            self.player_ids, self.players,
+            np.array(self.week_keys)[week_order], scores, self.total,
+            week_avg, week_std, self.teams, self.positions,
+        )
+
+
+def get_summary_df(full_df, total_score):
+    """Returns a dataframe with one row per `player_id`, the player's name,
+    their total score (`total_score`, aligned with the rows of `full_df`) for
+    each week, their season total, weekly average and weekly standard
+    deviation, and their team and position. Week columns are labeled
+    'YYYY-WW'.
+
+    The weekly scores are scattered into a dense player x week array keyed by
+    integer (season, week) codes, and the summary columns are computed on that
+    array. A player with more than one row in a week (two players whose raw
+    stats have no nflgame id and share a name) gets the sum of those rows'
+    scores.
+    """
+    week_keys = (full_df['season'].values.astype(np.int64) * 100 +
+                 full_df['week'].values.astype(np.int64))
+    week_codes, weeks = pd.factorize(week_keys, sort=True)
+    player_codes, player_ids = pd.factorize(full_df['player_id'], sort=True)
+    n_players, n_weeks = len(player_ids), len(weeks)
+
+    cell_codes = player_codes * n_weeks + week_codes
+    cell_counts = np.bincount(cell_codes, minlength=n_players * n_weeks)
+    log_collisions(np.count_nonzero(cell_counts > 1))
+    scores = np.bincount(cell_codes, weights=np.asarray(total_score, float),
+                         minlength=n_players * n_weeks)
+    scores = scores.reshape(n_players, n_weeks)
+
+    _, first_rows = np.unique(player_codes, return_index=True)
+    return make_summary_df(
+        player_ids, full_df['player'].values[first_rows], weeks, scores,
+        scores.sum(axis=1), scores.mean(axis=1), scores.std(axis=1, ddof=1),
+        full_df['team'].values[first_rows],
+        full_df['position'].values[first_rows],
     )
 
-    summary_df = pd.pivot_table(data=full_df, index='player', columns='week', values='total_score').fillna(0)
-    week_cols = summary_df.columns
-    summary_df['season_total'] = summary_df[week_cols].sum(axis=1)
-    summary_df['week_avg'] = summary_df[week_cols].mean(axis=1)
-    summary_df['week_std'] = summary_df[week_cols].std(axis=1)
-    summary_df = summary_df.sort_values('season_total', ascending=False)
-    summary_df = summary_df.join(
-        full_df.groupby('player').first()[['team', 'position']]
+
+def make_summary_df(player_ids, players, week_keys, scores, season_total,
+                    week_avg, week_std, teams, positions):
+    """Returns a score summary dataframe sorted by season total, given the
+    player x week array of `scores` and the per-player summary columns.
+    `week_keys` are integer season * 100 + week keys, and players are in
+    order of name, then id, before sorting.
+    """
+    order = sorted(range(len(players)),
+                   key=lambda i: (players[i], player_ids[i]))
+    week_labels = ['{}-{:02d}'.format(key // 100, key % 100)
+                   for key in week_keys]
+    summary_df = pd.DataFrame(
+        np.asarray(scores)[order], columns=week_labels,
+        index=pd.Index(np.asarray(player_ids, dtype=np.int64)[order],
+                       name='player_id'),
     )
-    summary_df.to_csv(scores_csv_path)
+    summary_df.insert(0, 'player', np.asarray(players, dtype=object)[order])
+    summary_df['season_total'] = np.asarray(season_total)[order]
+    summary_df['week_avg'] = np.asarray(week_avg)[order]
+    summary_df['week_std'] = np.asarray(week_std)[order]
+    summary_df['team'] = np.asarray(teams, dtype=object)[order]
+    summary_df['position'] = np.asarray(positions, dtype=object)[order]
+    # round before sorting so that totals that only differ by floating point
+    # error (from adding the same scores in a different order) stay in
+    # alphabetical order
+    sort_key = -np.round(summary_df['season_total'].values, 6)
+    return summary_df.iloc[np.argsort(sort_key, kind='mergesort')]
+
+
+def log_collisions(n_collisions):
+    if n_collisions:
+        logging.getLogger(__name__).warning(
+            '{} player-weeks have more than one row; their scores are '
+            'summed'.format(n_collisions)
+        )
 
 
 if __name__ == '__main__':
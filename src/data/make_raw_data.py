@@ -7,12 +7,16 @@
 #
 
 from collections import Counter
+from collections import OrderedDict
 from dotenv import find_dotenv, load_dotenv
 from pathlib2 import Path
-from subprocess import check_output
 import click
+import hashlib
+import json
 import logging
-import nflgame
+import multiprocessing
+import time
+import traceback
 import warnings
 with warnings.catch_warnings():
     # ignore warnings that are safe to ignore according to
@@ -21,155 +25,381 @@ with warnings.catch_warnings():
     warnings.simplefilter("ignore")
     import pandas as pd
 
+from src.data.sources import FixtureSource
+from src.data.sources import NflgameSource
+from src.data.storage import atomic_write_path
+from src.data.storage import get_partition_path
+from src.data.storage import write_raw_week
 from src.scoring import get_player_scoring_dict
 from src.scoring import get_team_scoring_dict
+from src.scoring import load_ruleset
+from src.scoring import ruleset_hash
+
+
+WEEKS = list(range(1, 18))
 
 
 @click.command()
 @click.argument('year', type=click.INT)
 @click.argument('scoring_method', type=click.STRING)
-def main(year=2017, scoring_method='nfl.com'):
+@click.option('--to-year', type=click.INT, default=None,
+              help='Last season to compile, if more than one (default: YEAR)')
+@click.option('--workers', '-j', type=click.INT, default=1,
+              help='Number of worker processes (0 for one per CPU)')
+@click.option('--force', is_flag=True,
+              help='Recompile every week, even ones that are up to date')
+@click.option('--fixtures-dir', type=click.Path(exists=True), default=None,
+              help='Replay games recorded by sources.py from this directory '
+                   'instead of using nflgame')
+@click.option('--raw-dir', type=click.Path(), default=None,
+              help='Where to write csv files (default: '
+                   '<project_dir>/data/raw)')
+@click.option('--dataset-dir', type=click.Path(), default=None,
+              help='Where to write the parquet raw stats dataset (default: '
+                   '<project_dir>/data/interim/raw-stats)')
+def main(year=2017, scoring_method='nfl.com', to_year=None, workers=1,
+         force=False, fixtures_dir=None, raw_dir=None, dataset_dir=None):
     """Compiles player and team stats relevant to fantasy scoring in
-    <project_dir>/data/raw/<year>/<year>_week-<week>.csv
-    """
-    # Update schedule so 2017 data can be used
-    python_path = Path(check_output(['which', 'python']).strip())
-    update_sched_path = (
-        python_path.parents[1] / 'lib' / 'python2.7' / 'site-packages' /
-        'nflgame' / 'update_sched.py'
-    )
-    print(check_output(
-        ['python', str(update_sched_path), '--year', str(year)]))
+    <project_dir>/data/raw/<year>/<year>_week-<week>.csv and the season/week
+    partitioned parquet dataset in <project_dir>/data/interim/raw-stats (see
+    storage.py) for every season from YEAR to --to-year. Each (season, week)
+    is a separate job, and with --workers > 1 the jobs are spread over a pool
+    of processes. A week that fails is logged and skipped without stopping
+    the other weeks.
 
+    <project_dir>/data/raw/manifest.json records the source fingerprint,
+    ruleset version and csv checksum of every compiled week, and weeks whose
+    entry still matches are skipped unless --force is given.
+
+    Games come from nflgame, or with --fixtures-dir from fixtures recorded by
+    sources.py, which makes runs reproducible and possible without network.
+    """
     logger = logging.getLogger(__name__)
-    logger.info('setting up csv files')
+    if to_year is None:
+        to_year = year
+    if workers == 0:
+        workers = multiprocessing.cpu_count()
+    if fixtures_dir is None:
+        source = NflgameSource()
+    else:
+        source = FixtureSource(fixtures_dir)
+    seasons = list(range(year, to_year + 1))
+    for season in seasons:
+        # Update schedule so recent seasons' data can be used
+        source.update_schedule(season)
 
+    logger.info('setting up csv files')
     project_dir = Path(__file__).resolve().parents[2]
-    year_data_dir = project_dir / 'data' / 'raw' / str(year)
-    year_data_dir.mkdir(parents=True, exist_ok=True)
+    if raw_dir is None:
+        raw_dir = project_dir / 'data' / 'raw'
+    if dataset_dir is None:
+        dataset_dir = project_dir / 'data' / 'interim' / 'raw-stats'
+    raw_dir = Path(raw_dir)
+    manifest_path = raw_dir / 'manifest.json'
+    manifest = load_manifest(manifest_path)
+    jobs = get_week_jobs(seasons, scoring_method, raw_dir, dataset_dir,
+                         source, manifest, force)
+    logger.info('{} of {} weeks are missing or stale'.format(
+        len(jobs), len(seasons) * len(WEEKS)
+    ))
+    if not jobs:
+        return
+
+    start_time = time.time()
+    failed_weeks = run_week_jobs(jobs, manifest, manifest_path, workers)
+    elapsed = time.time() - start_time
+    logger.info('compiled {} weeks in {:.1f} s with {} worker(s) '
+                '({:.2f} weeks/s)'.format(len(jobs), elapsed, workers,
+                                          len(jobs) / elapsed))
+    if failed_weeks:
+        raise click.ClickException('{} week(s) failed: {}'.format(
+            len(failed_weeks), sorted(failed_weeks)
+        ))
+
+
+def get_week_jobs(seasons, scoring_method, raw_dir, dataset_dir, source,
+                  manifest, force=False):
+    """Returns a list of `make_week_csv` job tuples for every week of
+    `seasons` that isn't current according to `manifest`, or for every week
+    if `force` is True
+    """
+    ruleset_version = ruleset_hash(load_ruleset(scoring_method))
+    jobs = []
+    for season in seasons:
+        year_data_dir = raw_dir / str(season)
+        year_data_dir.mkdir(parents=True, exist_ok=True)
+        for week in WEEKS:
+            entry = manifest.get(get_manifest_key(season, week))
+            csv_path = year_data_dir / get_week_csv_name(season, week)
+            partition_path = get_partition_path(dataset_dir, season, week)
+            if not force and is_week_current(
+                    entry, csv_path, partition_path,
+                    source.get_fingerprint(season, week), ruleset_version):
+                continue
+            jobs.append((season, week, scoring_method, str(year_data_dir),
+                         str(dataset_dir), source))
+    return jobs
+
+
+def run_week_jobs(jobs, manifest, manifest_path, workers=1):
+    """Runs `make_week_csv` on every job, in a pool of `workers` processes if
+    `workers` > 1, and returns a list of the `(year, week)` pairs that failed.
+    `manifest` is updated and saved to `manifest_path` as each week finishes.
+    """
+    logger = logging.getLogger(__name__)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(make_week_csv, jobs)
+    else:
+        pool = None
+        results = (make_week_csv(job) for job in jobs)
+    failed_weeks = []
+    for year, week, error, entry in results:
+        if error is None:
+            logger.info('wrote {} week {}'.format(year, week))
+            manifest[get_manifest_key(year, week)] = entry
+            save_manifest(manifest, manifest_path)
+        else:
+            logger.error('{} week {} failed:\n{}'.format(year, week, error))
+            failed_weeks.append((year, week))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return failed_weeks
+
+
+def get_week_csv_name(year, week):
+    return '{}_week-{:02d}.csv'.format(year, week)
+
+
+def make_week_csv(job):
+    """Writes <year_data_dir>/<year>_week-<week>.csv and the week's partition
+    of the raw stats dataset in `dataset_dir` for a `(year, week,
+    scoring_method, year_data_dir, dataset_dir, source)` job tuple. Returns a
+    `(year, week, error, manifest_entry)` tuple where `error` is None on
+    success or the formatted traceback of the exception that stopped the week,
+    so that one bad week can be reported without killing a worker pool.
+    """
+    year, week, scoring_method, year_data_dir, dataset_dir, source = job
+    try:
+        df_week = get_player_and_team_data(year, week, scoring_method, source)
+        filename = Path(year_data_dir) / get_week_csv_name(year, week)
+        write_csv_atomically(df_week, filename)
+        write_raw_week(df_week, dataset_dir, year, week)
+        manifest_entry = {
+            'source_fingerprint': source.get_fingerprint(year, week),
+            'ruleset_version': ruleset_hash(load_ruleset(scoring_method)),
+            'checksum': get_file_checksum(filename),
+        }
+    except Exception:
+        return year, week, traceback.format_exc(), None
+    return year, week, None, manifest_entry
+
+
+def write_csv_atomically(df, path):
+    with atomic_write_path(path) as tmp_path:
+        df.to_csv(str(tmp_path), index=False)
+
+
+def get_manifest_key(year, week):
+    return '{}-{:02d}'.format(year, week)
+
+
+def load_manifest(manifest_path):
+    """Returns the manifest of compiled weeks, a dictionary of entries keyed
+    by `get_manifest_key`, or an empty dictionary if there isn't one yet
+    """
+    manifest_path = Path(manifest_path)
+    if not manifest_path.exists():
+        return {}
+    with manifest_path.open() as f:
+        return json.load(f)
 
-    # For every week in the weeks list, grab the player game logs and create a
-    # csv file for each week
-    weeks = list(range(1, 18))
-    for week in weeks:
-        df_week = get_player_and_team_data(year, week)
-        filename = year_data_dir / '{}_week-{:02d}.csv'.format(year, week)
-        df_week.to_csv(filename, index=False)
 
+def save_manifest(manifest, manifest_path):
+    with atomic_write_path(manifest_path) as tmp_path:
+        with open(str(tmp_path), 'w') as f:
+            json.dump(manifest, f, indent=2, separators=(',', ': '),
+                      sort_keys=True)
 
-def get_player_and_team_data(year, week, scoring_method='nfl.com'):
+
+def is_week_current(manifest_entry, csv_path, partition_path,
+                    source_fingerprint, ruleset_version):
+    """Returns True if a week's csv file exists with the checksum recorded in
+    its manifest entry, its partition of the raw stats dataset exists, and the
+    entry's source fingerprint and ruleset version match the current ones.
+    Weeks without a fingerprint are never current.
+    """
+    return (
+        manifest_entry is not None and
+        source_fingerprint is not None and
+        manifest_entry['source_fingerprint'] == source_fingerprint and
+        manifest_entry['ruleset_version'] == ruleset_version and
+        Path(csv_path).exists() and
+        Path(partition_path).exists() and
+        manifest_entry['checksum'] == get_file_checksum(csv_path)
+    )
+
+
+def get_file_checksum(path):
+    checksum = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def get_player_and_team_data(year, week, scoring_method='nfl.com',
+                             source=None):
     """Returns a dataframe of stats for all teams and players (with nonzero
-    useful stats) for a given week in a given season.
+    useful stats) for a given week in a given season. Games come from
+    `source` (see sources.py), which defaults to nflgame.
 
     If ppr is True, uses point-per-reception scoring. Otherwise uses 1/2 point
     per reception.
     """
-    df = pd.DataFrame()
-    defense_two_pt_returns_dict = get_defense_two_pt_returns(year, week)
+    if source is None:
+        source = NflgameSource()
+    records = []
     player_scoring_dict = get_player_scoring_dict(method=scoring_method)
     team_scoring_dict = get_team_scoring_dict()
-    for game in nflgame.games(year, week):
+    defense_stats = [
+        team_stat.replace('team_', '') for team_stat in team_scoring_dict
+        if team_stat not in ['team_defense_two_pt_return',
+                             'team_points_allowed']
+    ]
+    player_two_pt_returns = Counter()
+    games = source.games(year, week)
+    for game in games:
+        plays = source.combine_plays([game])
+        team_stats, two_pt_returns = get_game_defense_stats(
+            game, plays, defense_stats
+        )
+        player_two_pt_returns.update(two_pt_returns['players'])
         for team, opp_score in zip([game.home, game.away],
                                    [game.score_away, game.score_home]):
-            i_row = len(df)
-            team = team
-            df.loc[i_row, 'week'] = week
-            df.loc[i_row, 'team'] = team
-            df.loc[i_row, 'position'] = 'DEFENSE'
-            df.loc[i_row, 'player'] = team + '-DEFENSE'
+            record = OrderedDict()
+            record['week'] = week
+            record['team'] = team
+            record['position'] = 'DEFENSE'
+            record['player'] = team + '-DEFENSE'
+            record['gsis_id'] = team + '-DEFENSE'
             for team_stat in team_scoring_dict:
                 if team_stat == 'team_defense_two_pt_return':
-                    df.loc[i_row, team_stat] = (
-                        defense_two_pt_returns_dict['teams'][team]
-                    )
+                    record[team_stat] = two_pt_returns['teams'][team]
                 elif team_stat == 'team_points_allowed':
-                    df.loc[i_row, team_stat] = opp_score
+                    record[team_stat] = opp_score
                 else:
                     stat = team_stat.replace('team_', '')
-                    df.loc[i_row, team_stat] = get_team_defense_stat(
-                        game, team, stat
-                    )
-    players = nflgame.combine_max_stats(nflgame.games(year, week))
+                    record[team_stat] = team_stats[team][stat]
+            records.append(record)
+    players = source.combine_max_stats(games)
     for player in players:
-        i_row = len(df)
-        df.loc[i_row, 'week'] = week
-        df.loc[i_row, 'team'] = player.team
-        df.loc[i_row, 'position'] = player.guess_position
-        df.loc[i_row, 'player'] = player.name
-        df.loc[i_row, 'defense_two_pt_return'] = (
-            defense_two_pt_returns_dict['players'][player.name]
-        )
+        record = OrderedDict()
+        record['week'] = week
+        record['team'] = player.team
+        record['position'] = player.guess_position
+        record['player'] = player.name
+        record['gsis_id'] = player.playerid
+        record['defense_two_pt_return'] = player_two_pt_returns[player.name]
         for stat in player._stats:
             if stat in player_scoring_dict:
-                df.loc[i_row, stat] = getattr(player, stat)
-    return df
+                record[stat] = getattr(player, stat)
+        records.append(record)
+    return records_to_df(records)
 
 
-def get_defense_two_pt_returns(year, week):
-    """Returns a dictionary of `players` and `teams` Counters, which store the
-    number of defensive 2 point returns awarded to any player and team for a
-    given week of play. This function is necessary because there don't seem to
-    be easy ways to get this stat otherwise.
+def records_to_df(records):
+    """Returns a dataframe built in one go from a list of row dictionaries.
+    Columns are ordered by when they first appear in `records`, rows missing a
+    column get NaN, and every column except `team`, `position`, `player` and
+    `gsis_id` is stored as floats.
     """
-    defense_two_pt_returns_dict = {
-        'players': Counter(),
-        'teams': Counter(),
-    }
-    for game in nflgame.games(year, week):
-        home_team, away_team = game.home, game.away
-        for play in nflgame.combine_plays([game]):
-            if ('DEFENSIVE TWO-POINT ATTEMPT' in str(play) and
-                    'ATTEMPT SUCCEEDS' in str(play)):
-                # Determine scoring team
-                if play.team == home_team:
-                    team = away_team
-                else:
-                    team = home_team
-                # Guess scoring player. Can't find any stats for this, but the
-                # scoring player is usually listed at the beginning of the
-                # sentence before "ATTEMPT SUCCEEDS" in the play description.
-                sentences = str(play).split('. ')
-                i = -1
-                while 'ATTEMPT SUCCEEDS' not in sentences[i+1]:
-                    i += 1
-                player = sentences[i].split()[0]
-                # Add to counters for player and team
-                defense_two_pt_returns_dict['players'][player] += 1
-                defense_two_pt_returns_dict['teams'][team] += 1
-    return defense_two_pt_returns_dict
-
-
-def get_team_defense_stat(game, team, stat):
-    """Returns the count of a particular stat awarded to a team on a given week
-    of play.
+    columns = []
+    seen_columns = set()
+    for record in records:
+        for column in record:
+            if column not in seen_columns:
+                seen_columns.add(column)
+                columns.append(column)
+    df = pd.DataFrame.from_records(records, columns=columns)
+    numeric_columns = [c for c in columns
+                       if c not in ['team', 'position', 'player', 'gsis_id']]
+    df[numeric_columns] = df[numeric_columns].astype(float)
+    return df
+
+
+def get_game_defense_stats(game, plays, stats):
+    """Returns a tuple of a dictionary of team defense stat Counters keyed by
+    team and a dictionary of `players` and `teams` Counters of defensive 2
+    point returns, all built in a single pass over `plays`, the combined plays
+    of `game`. `stats` are the nflgame play stats to count for each team, e.g.
+    `defense_sk`.
+
+    A team is credited with a play's stats when the play's team is not that
+    team. Fumble recoveries are the exception: on punting/kicking plays they
+    go to the team that starts with the ball.
 
     Code modified from https://github.com/BurntSushi/nflgame/wiki/Cookbook
     #calculate-number-of-sacks-for-a-team
     Filter part of modification comes from last comment of
     https://github.com/BurntSushi/nflgame/issues/48
     """
-    plays = nflgame.combine_plays([game])
-
-    count = 0
-    if stat == 'defense_frec':
-        for play in plays.filter(defense_frec__gt=0):
-            if (play.punting_tot == 0) and (play.kicking_tot == 0):
-                # defensive fumble recoveries go to the team that doesn't start
-                # with the ball if it's not a punting/kicking play
-                if play.team != team:
-                    count += getattr(play, stat)
-            else:
-                # defensive fumble recoveries go to the team that starts with
-                # the ball if it's a punting/kicking play
-                if play.team == team:
-                    count += getattr(play, stat)
-    elif stat == 'defense_two_pt_return':
+    if 'defense_two_pt_return' in stats:
         raise ValueError("defense_two_pt_return should be handled outside of "
-                         "get_team_defense_stat()!")
+                         "the team stat counters!")
+    home_team, away_team = game.home, game.away
+    team_stats = {home_team: Counter(), away_team: Counter()}
+    two_pt_returns = {
+        'players': Counter(),
+        'teams': Counter(),
+    }
+    count_frec = 'defense_frec' in stats
+    other_stats = [stat for stat in stats if stat != 'defense_frec']
+    for play in plays:
+        for team in [home_team, away_team]:
+            if play.team != team:
+                for stat in other_stats:
+                    team_stats[team][stat] += getattr(play, stat)
+        if count_frec and play.defense_frec > 0:
+            for team in get_fumble_recovery_teams(play, home_team, away_team):
+                team_stats[team]['defense_frec'] += play.defense_frec
+        description = str(play)
+        if ('DEFENSIVE TWO-POINT ATTEMPT' in description and
+                'ATTEMPT SUCCEEDS' in description):
+            # Scoring team is the one that didn't start the play with the ball
+            if play.team == home_team:
+                team = away_team
+            else:
+                team = home_team
+            player = get_two_pt_returner(description)
+            two_pt_returns['players'][player] += 1
+            two_pt_returns['teams'][team] += 1
+    return team_stats, two_pt_returns
+
+
+def get_fumble_recovery_teams(play, home_team, away_team):
+    """Returns the teams credited with a play's defensive fumble recoveries.
+    They go to the team that doesn't start with the ball if it's not a
+    punting/kicking play, and to the team that starts with the ball if it is.
+    """
+    if (play.punting_tot == 0) and (play.kicking_tot == 0):
+        return [team for team in [home_team, away_team] if play.team != team]
     else:
-        for play in plays.filter(team__ne=team):
-            count += getattr(play, stat)
-    return count
+        return [team for team in [home_team, away_team] if play.team == team]
+
+
+def get_two_pt_returner(description):
+    """Guess the player who scored a defensive 2 point return from a play
+    description. Can't find any stats for this, but the scoring player is
+    usually listed at the beginning of the sentence before "ATTEMPT SUCCEEDS"
+    in the play description.
+    """
+    sentences = description.split('. ')
+    i = -1
+    while 'ATTEMPT SUCCEEDS' not in sentences[i+1]:
+        i += 1
+    return sentences[i].split()[0]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# players.py
+#
+# Copyright (c) 2018 Ben Lindsay <benjlindsay@gmail.com>
+#
+
+"""Stable integer ids for players, so that players who share a display name
+like 'J.Brown' are never mixed up.
+
+A player is identified by a key: their nflgame player id (the `gsis_id`
+column of the raw stats) or, for raw stats compiled before that column
+existed, their name, as the summaries always used to be, so a player who
+changes teams or positions keeps one row. Team defenses are identified by
+their name, e.g. 'NE-DEFENSE'. The registry assigns each new key the next
+integer id and stores the ids in a csv file next to the processed data, so a
+player keeps the same id every time the data is rebuilt.
+"""
+
+from pathlib2 import Path
+import numpy as np
+import warnings
+with warnings.catch_warnings():
+    # ignore warnings that are safe to ignore according to
+    # https://github.com/ContinuumIO/anaconda-issues/issues/6678
+    # #issuecomment-337276215
+    warnings.simplefilter("ignore")
+    import pandas as pd
+
+from src.data.storage import atomic_write_path
+
+REGISTRY_COLUMNS = ['player_id', 'key', 'player', 'team', 'position']
+
+
+class PlayerRegistry(object):
+    """Integer player ids keyed by player key (see `get_player_keys`), read
+    from and saved to the csv file at `path`. Each id is stored with the
+    player's name, team and position when they were first seen.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        if self.path.exists():
+            df = pd.read_csv(str(self.path), dtype={'key': str},
+                             keep_default_na=False)
+        else:
+            df = pd.DataFrame(columns=REGISTRY_COLUMNS)
+        self.ids = dict(zip(df['key'], df['player_id'].astype(int)))
+        self.rows = df[REGISTRY_COLUMNS].values.tolist()
+        self.next_id = max(self.ids.values()) + 1 if self.ids else 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_ids(self, stats_df):
+        """Returns an array with the id of the player of each row of
+        `stats_df`, registering players that don't have one yet
+        """
+        key_codes, keys = pd.factorize(get_player_keys(stats_df))
+        _, first_rows = np.unique(key_codes, return_index=True)
+        ids = np.empty(len(keys), dtype=np.int64)
+        for i, (key, row) in enumerate(zip(keys, first_rows)):
+            if key not in self.ids:
+                self.ids[key] = self.next_id
+                self.rows.append([
+                    self.next_id, key, stats_df['player'].values[row],
+                    stats_df['team'].values[row],
+                    stats_df['position'].values[row],
+                ])
+                self.next_id += 1
+            ids[i] = self.ids[key]
+        return ids[key_codes]
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        df = pd.DataFrame(self.rows, columns=REGISTRY_COLUMNS)
+        with atomic_write_path(self.path) as tmp_path:
+            df.to_csv(str(tmp_path), index=False)
+
+
+def get_player_keys(stats_df):
+    """Returns a series with the player key of each row of `stats_df`"""
+    players = stats_df['player'].astype(str)
+    if 'gsis_id' not in stats_df.columns:
+        return players
+    gsis_ids = stats_df['gsis_id'].fillna('').astype(str)
+    keys = gsis_ids.where(~gsis_ids.isin(['', '0', '0.0']), players)
+    return players.where(stats_df['position'] == 'DEFENSE', keys)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# sources.py
+#
+# Copyright (c) 2018 Ben Lindsay <benjlindsay@gmail.com>
+#
+
+"""Game data sources for make_raw_data.py. A source provides `games(year,
+week)`, `combine_plays(games)` and `combine_max_stats(games)` like the nflgame
+functions of the same names, plus `update_schedule(year)` and
+`get_fingerprint(year, week)`.
+"""
+
+from collections import OrderedDict
+from pathlib2 import Path
+from subprocess import check_output
+import click
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+
+class NflgameSource(object):
+    """Game data from the nflgame package. nflgame is only imported when it's
+    used, as importing it updates its schedule over the network, which
+    FixtureSource is meant to work without.
+    """
+
+    def games(self, year, week):
+        import nflgame
+        return nflgame.games(year, week)
+
+    def combine_plays(self, games):
+        import nflgame
+        return nflgame.combine_plays(games)
+
+    def combine_max_stats(self, games):
+        import nflgame
+        return nflgame.combine_max_stats(games)
+
+    def update_schedule(self, year):
+        """Run nflgame's update_sched.py script so `year`'s games can be
+        found
+        """
+        python_path = Path(check_output(['which', 'python']).strip())
+        update_sched_path = (
+            python_path.parents[1] / 'lib' / 'python2.7' / 'site-packages' /
+            'nflgame' / 'update_sched.py'
+        )
+        print(check_output(
+            ['python', str(update_sched_path), '--year', str(year)]))
+
+    def get_fingerprint(self, year, week):
+        """Returns a hash of the nflgame data a regular season week is
+        compiled from: the week's games in nflgame's schedule and the size and
+        modification time of nflgame's local copy of each game's gamecenter
+        JSON. nflgame only keeps that copy once a game is over, so this
+        returns None while any of the week's games are unplayed or in
+        progress.
+        """
+        import nflgame
+        gamecenter_dir = os.path.join(os.path.dirname(nflgame.__file__),
+                                      'gamecenter-json')
+        games = []
+        for eid, info in sorted(nflgame.sched.games.items()):
+            if (info['year'], info['week'],
+                    info['season_type']) != (year, week, 'REG'):
+                continue
+            json_path = os.path.join(gamecenter_dir, eid + '.json.gz')
+            if not os.path.isfile(json_path):
+                return None
+            json_stat = os.stat(json_path)
+            games.append([eid, info['home'], info['away'], json_stat.st_size,
+                          int(json_stat.st_mtime)])
+        if not games:
+            return None
+        return hashlib.sha1(json.dumps(games).encode('utf-8')).hexdigest()
+
+
+class FixtureSource(object):
+    """Game data replayed from fixtures written by `record_fixture`, so that
+    raw data can be compiled without nflgame's network access
+    """
+
+    def __init__(self, fixtures_dir):
+        self.fixtures_dir = str(fixtures_dir)
+
+    def games(self, year, week):
+        path = get_fixture_path(self.fixtures_dir, year, week)
+        with gzip.open(str(path)) as f:
+            fixture = json.loads(f.read().decode('utf-8'))
+        return [FixtureGame(game) for game in fixture['games']]
+
+    def combine_plays(self, games):
+        return [play for game in games for play in game.plays]
+
+    def combine_max_stats(self, games):
+        return [player for game in games for player in game.players]
+
+    def update_schedule(self, year):
+        pass
+
+    def get_fingerprint(self, year, week):
+        """Returns a hash of the week's fixture file, or None if there isn't
+        one
+        """
+        path = get_fixture_path(self.fixtures_dir, year, week)
+        if not path.exists():
+            return None
+        with path.open('rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+
+class FixtureStats(object):
+    """Recorded play or player stats, given as a list of `[stat, value]`
+    pairs in their original order. Like nflgame, stats that weren't recorded
+    are 0.
+    """
+
+    def __init__(self, stats):
+        self._stats = OrderedDict(stats)
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return self._stats.get(item, 0)
+
+
+class FixturePlay(FixtureStats):
+
+    def __init__(self, play):
+        FixtureStats.__init__(self, play['stats'])
+        self.team = play['team']
+        self.description = play['description']
+
+    def __str__(self):
+        return self.description
+
+
+class FixturePlayer(FixtureStats):
+
+    def __init__(self, player):
+        FixtureStats.__init__(self, player['stats'])
+        self.playerid = player['playerid']
+        self.name = player['name']
+        self.team = player['team']
+        self.guess_position = player['guess_position']
+
+
+class FixtureGame(object):
+
+    def __init__(self, game):
+        self.eid = game['eid']
+        self.home = game['home']
+        self.away = game['away']
+        self.score_home = game['score_home']
+        self.score_away = game['score_away']
+        self.plays = [FixturePlay(play) for play in game['plays']]
+        self.players = [FixturePlayer(player) for player in game['players']]
+
+
+def get_fixture_path(fixtures_dir, year, week):
+    return (Path(fixtures_dir) / str(year) /
+            '{}_week-{:02d}.json.gz'.format(year, week))
+
+
+def record_fixture(source, year, week, fixtures_dir):
+    """Records the games, plays and players `source` returns for a week as
+    <fixtures_dir>/<year>/<year>_week-<week>.json.gz. Only the attributes
+    make_raw_data.py uses are kept. Plays, players and each player's stats
+    keep their order, so replaying a fixture produces the same csv columns and
+    rows as the original source.
+    """
+    games = []
+    for game in source.games(year, week):
+        games.append({
+            'eid': game.eid,
+            'home': game.home,
+            'away': game.away,
+            'score_home': game.score_home,
+            'score_away': game.score_away,
+            'plays': [{
+                'team': play.team,
+                'description': str(play),
+                'stats': get_stats(play),
+            } for play in source.combine_plays([game])],
+            'players': [{
+                'playerid': player.playerid,
+                'name': player.name,
+                'team': player.team,
+                'guess_position': player.guess_position,
+                'stats': get_stats(player),
+            } for player in source.combine_max_stats([game])],
+        })
+    path = get_fixture_path(fixtures_dir, year, week)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(str(path), 'wb') as f:
+        f.write(json.dumps({'games': games}, sort_keys=True,
+                           separators=(',', ':')).encode('utf-8'))
+    return path
+
+
+def get_stats(play_or_player):
+    return [[stat, value] for stat, value in play_or_player._stats.items()]
+
+
+@click.command()
+@click.argument('year', type=click.INT)
+@click.option('--to-year', type=click.INT, default=None,
+              help='Last season to record, if more than one (default: YEAR)')
+@click.option('--fixtures-dir', type=click.Path(), default=None,
+              help='Where to write fixtures (default: '
+                   '<project_dir>/data/external/nflgame-fixtures)')
+def main(year=2017, to_year=None, fixtures_dir=None):
+    """Records nflgame data for every regular season week from YEAR to
+    --to-year as fixtures that make_raw_data.py can replay offline with
+    --fixtures-dir
+    """
+    logger = logging.getLogger(__name__)
+    if to_year is None:
+        to_year = year
+    if fixtures_dir is None:
+        project_dir = Path(__file__).resolve().parents[2]
+        fixtures_dir = project_dir / 'data' / 'external' / 'nflgame-fixtures'
+    source = NflgameSource()
+    for season in range(year, to_year + 1):
+        source.update_schedule(season)
+        for week in range(1, 18):
+            path = record_fixture(source, season, week, fixtures_dir)
+            logger.info('recorded {}'.format(path))
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
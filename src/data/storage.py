@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# storage.py
+#
+# Copyright (c) 2018 Ben Lindsay <benjlindsay@gmail.com>
+#
+
+"""Columnar (Parquet) storage for raw stats and score summaries.
+
+Raw stats are kept in one dataset partitioned by season and week:
+
+    <dataset_dir>/season=<season>/week=<week>/part-0.parquet
+
+The season and week are only stored in the directory names, so reads that
+select seasons or weeks never open the other partitions, and reads that
+select columns only decode those columns.
+"""
+
+from contextlib import contextmanager
+from pathlib2 import Path
+import click
+import logging
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+import warnings
+with warnings.catch_warnings():
+    # ignore warnings that are safe to ignore according to
+    # https://github.com/ContinuumIO/anaconda-issues/issues/6678
+    # #issuecomment-337276215
+    warnings.simplefilter("ignore")
+    import pandas as pd
+
+PARTITION_COLUMNS = ['season', 'week']
+
+
+def get_partition_path(dataset_dir, season, week):
+    return (Path(dataset_dir) / 'season={}'.format(season) /
+            'week={}'.format(week) / 'part-0.parquet')
+
+
+@contextmanager
+def atomic_write_path(path):
+    """Yields a temporary path next to `path` to write to, then renames it to
+    `path`, so readers never see a partially written file
+    """
+    path = Path(path)
+    tmp_path = path.with_name('.{}.{}.tmp'.format(path.name, os.getpid()))
+    try:
+        yield tmp_path
+        os.rename(str(tmp_path), str(path))
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def write_parquet_atomically(df, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Python 2 strings are bytes, which parquet would store as binary and
+    # Python 3 would read back as bytes, so store them as utf-8 text
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].map(decode_bytes)
+    with atomic_write_path(path) as tmp_path:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(table, str(tmp_path))
+
+
+def decode_bytes(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def write_raw_week(df, dataset_dir, season, week):
+    """Writes one week of raw stats (as compiled by make_raw_data.py) to its
+    partition of the raw stats dataset
+    """
+    df = df.drop([c for c in PARTITION_COLUMNS if c in df.columns], axis=1)
+    write_parquet_atomically(df, get_partition_path(dataset_dir, season, week))
+
+
+def get_partitions(dataset_dir, seasons=None, weeks=None):
+    """Returns a sorted list of `(season, week, path)` tuples for the
+    partitions of the raw stats dataset, keeping only `seasons` and `weeks` if
+    they are given
+    """
+    partitions = []
+    for season_dir in Path(dataset_dir).glob('season=*'):
+        season = int(season_dir.name.split('=')[1])
+        if seasons is not None and season not in seasons:
+            continue
+        for week_dir in season_dir.glob('week=*'):
+            week = int(week_dir.name.split('=')[1])
+            if weeks is not None and week not in weeks:
+                continue
+            partitions.append((season, week, week_dir / 'part-0.parquet'))
+    return sorted(partitions)
+
+
+def read_raw_stats(dataset_dir, seasons=None, weeks=None, columns=None):
+    """Returns a dataframe of raw stats with `season` and `week` columns for
+    the selected `seasons` and `weeks` (all of them by default). If `columns`
+    is given, only those columns are read; columns a partition doesn't have
+    are left as NaN.
+    """
+    df_list = []
+    for season, week, path in get_partitions(dataset_dir, seasons, weeks):
+        if columns is None:
+            df = pq.read_table(str(path)).to_pandas()
+        else:
+            schema_names = pq.read_schema(str(path)).names
+            df = pq.read_table(
+                str(path),
+                columns=[c for c in columns if c in schema_names],
+            ).to_pandas()
+        df.insert(0, 'season', season)
+        df.insert(1, 'week', week)
+        df_list.append(df)
+    if not df_list:
+        return pd.DataFrame(columns=PARTITION_COLUMNS + list(columns or []))
+    df = pd.concat(df_list, sort=False).reset_index(drop=True)
+    if columns is not None:
+        df = df.reindex(columns=PARTITION_COLUMNS + [
+            c for c in columns if c not in PARTITION_COLUMNS
+        ])
+    return df
+
+
+def write_summary(summary_df, path):
+    """Writes a score summary (as made by make_dataset.py) with typed columns:
+    categorical `team` and `position` and float scores
+    """
+    summary_df = summary_df.reset_index()
+    for column in ['team', 'position']:
+        summary_df[column] = (
+            summary_df[column].astype(str).map(decode_bytes).astype('category')
+        )
+    write_parquet_atomically(summary_df, path)
+
+
+def read_summary(path, columns=None):
+    return pd.read_parquet(str(path), columns=columns)
+
+
+@click.command()
+@click.argument('from_season', type=click.INT)
+@click.argument('to_season', type=click.INT)
+def main(from_season=2009, to_season=2017):
+    """Imports the weekly csv files in <project_dir>/data/raw into the raw
+    stats dataset in <project_dir>/data/interim/raw-stats
+    """
+    logger = logging.getLogger(__name__)
+    project_dir = Path(__file__).resolve().parents[2]
+    raw_dir = project_dir / 'data' / 'raw'
+    dataset_dir = project_dir / 'data' / 'interim' / 'raw-stats'
+    for season in range(from_season, to_season + 1):
+        for csv_file in sorted((raw_dir / str(season)).glob('*.csv')):
+            df = pd.read_csv(str(csv_file))
+            week = int(csv_file.stem.split('-')[-1])
+            write_raw_week(df, dataset_dir, season, week)
+            logger.info('imported {}'.format(csv_file.name))
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -5,157 +5,292 @@
 #
 # Copyright (c) 2018 Ben Lindsay <benjlindsay@gmail.com>
 
+import copy
+import hashlib
+import json
+import numpy as np
+import os
+import warnings
+with warnings.catch_warnings():
+    # ignore warnings that are safe to ignore according to
+    # https://github.com/ContinuumIO/anaconda-issues/issues/6678
+    # #issuecomment-337276215
+    warnings.simplefilter("ignore")
+    import pandas as pd
 
-def team_points_allowed_fn(points_allowed):
-    """Return fantasy points scored by a defense based on the number of points
-    they allowed. Based on point scale found on
-    https://fantasydata.com/developers/fantasy-scoring-system/nfl
+
+class LinearRule(object):
+    """A scoring rule worth a fixed number of points per unit of a stat.
+    Calling it on a stat value behaves like `lambda x: x * points`.
     """
-    if points_allowed == 0:
-        return 10
-    elif points_allowed < 7:
-        return 7
-    elif points_allowed < 14:
-        return 4
-    elif points_allowed < 21:
-        return 1
-    elif points_allowed < 28:
-        return 0
-    elif points_allowed < 35:
-        return - 1
+
+    def __init__(self, points):
+        self.points = points
+
+    def __call__(self, x):
+        return x * self.points
+
+    def __repr__(self):
+        return 'LinearRule({!r})'.format(self.points)
+
+
+class TierRule(object):
+    """A scoring rule that awards the points of the first tier whose condition
+    matches a stat value, like a chain of if/elif statements. Each tier is an
+    `(operator, bound, points)` tuple, e.g. `('<', 7, 4)`, and `default` is
+    awarded when no tier matches.
+    """
+    OPERATORS = {
+        '==': np.equal,
+        '<': np.less,
+        '<=': np.less_equal,
+        '>': np.greater,
+        '>=': np.greater_equal,
+    }
+
+    def __init__(self, tiers, default=0):
+        for op, bound, points in tiers:
+            if op not in self.OPERATORS:
+                raise ValueError("{} is not a valid tier operator!".format(op))
+        self.tiers = [tuple(tier) for tier in tiers]
+        self.default = default
+
+    def __call__(self, x):
+        for op, bound, points in self.tiers:
+            if self.OPERATORS[op](x, bound):
+                return points
+        return self.default
+
+    def __repr__(self):
+        return 'TierRule({!r}, default={!r})'.format(self.tiers, self.default)
+
+    def evaluate(self, values):
+        """Vectorized version of calling the rule on every element of
+        `values`
+        """
+        conditions = [self.OPERATORS[op](values, bound)
+                      for op, bound, _ in self.tiers]
+        choices = [float(points) for _, _, points in self.tiers]
+        return np.select(conditions, choices, default=float(self.default))
+
+
+RULESETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'rulesets')
+_RULESET_CACHE = {}
+_ENGINE_CACHE = {}
+
+
+def load_ruleset(method='nfl.com'):
+    """Returns a scoring ruleset loaded from a JSON file. `method` is either
+    the path to a ruleset file or the name of one of the rulesets in
+    `RULESETS_DIR` (e.g. 'nfl.com' or 'fantasydata.com').
+
+    A ruleset has a `name`, a `team` dictionary and a `player` dictionary of
+    scoring rules. Each rule is either a number of points per unit of the stat
+    or a dictionary of `tiers` and a `default` as described in `TierRule`:
+
+        "kicking_fgm_yds": {"tiers": [[">=", 50, 5], [">", 0, 3]],
+                            "default": 0}
+
+    A ruleset may instead name another ruleset (or a file path relative to its
+    own file) in `extends` and only list the rules it changes, e.g. a half-PPR
+    league that sets `receiving_rec` to 0.5. A rule set to `null` removes that
+    stat from the base ruleset. If `name` is missing, the file name is used.
+    """
+    if os.path.isfile(method):
+        path = os.path.abspath(method)
     else:
-        return -4
+        path = os.path.join(RULESETS_DIR, method + '.json')
+        if not os.path.isfile(path):
+            raise ValueError(
+                "{} is not a valid value for `method`!".format(method)
+            )
+    mtime = os.path.getmtime(path)
+    if path not in _RULESET_CACHE or _RULESET_CACHE[path][0] != mtime:
+        with open(path) as f:
+            _RULESET_CACHE[path] = (mtime, json.load(f))
+    ruleset = copy.deepcopy(_RULESET_CACHE[path][1])
+    ruleset.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+    if 'extends' in ruleset:
+        base_method = ruleset.pop('extends')
+        relative_path = os.path.join(os.path.dirname(path), base_method)
+        if os.path.isfile(relative_path):
+            base_method = relative_path
+        base = load_ruleset(base_method)
+        for section in ['team', 'player']:
+            rules = base[section]
+            rules.update(ruleset.get(section, {}))
+            ruleset[section] = {stat: rule for stat, rule in rules.items()
+                                if rule is not None}
+    return ruleset
+
+
+def ruleset_hash(ruleset):
+    """Returns a hash of the contents of a ruleset that doesn't depend on key
+    order or formatting of the file it came from
+    """
+    canonical = json.dumps(ruleset, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def parse_rules(rules):
+    """Returns a scoring dictionary of `LinearRule` and `TierRule` objects
+    from the `team` or `player` section of a ruleset
+    """
+    scoring_dict = {}
+    for stat, rule in rules.items():
+        if isinstance(rule, dict):
+            scoring_dict[stat] = TierRule(rule['tiers'],
+                                          default=rule.get('default', 0))
+        else:
+            scoring_dict[stat] = LinearRule(rule)
+    return scoring_dict
 
 
 def get_player_scoring_dict(method='nfl.com'):
     """Returns a dictionary of scoring rules for each individual player stat.
     All stats in this dictionary are part of the nflgame API except for
-    defense_two_pt_return. 
+    defense_two_pt_return. The rules come from the `player` section of the
+    ruleset loaded by `load_ruleset(method)`.
 
     Modified from
       https://github.com/BurntSushi/nflgame/wiki/Cookbook
       #calculate-the-fantasy-score-of-all-players-for-a-week
     """
-    if method == 'nfl.com':
-        ppr = True
-        player_scoring_dict = {
-            # OFFENSE
-            #   Passing Yards
-            'passing_yds': lambda x: x * .04,
-            #   Passing Touchdowns
-            'passing_tds': lambda x: x * 4,
-            #   Interceptions Thrown
-            'passing_ints': lambda x: x * -2,
-            #   Rushing Yards
-            'rushing_yds': lambda x: x * .1,
-            #   Rushing Touchdowns
-            'rushing_tds': lambda x: x * 6,
-            #   Receptions
-            'receiving_rec': lambda x: x * 1 if ppr else x * 0.5,
-            #   Receiving Yards
-            'receiving_yds': lambda x: x * .1,
-            #   Receiving Touchdowns
-            'receiving_tds': lambda x: x * 6,
-            #   Fumbles Recovered for TD
-            'fumbles_rec_tds': lambda x: x * 6,
-            #   Fumbles Lost
-            'fumbles_lost': lambda x: x * -2,
-            #   2-point conversions
-            'passing_twoptm': lambda x: x * 2,
-            'rushing_twoptm': lambda x: x * 2,
-            'receiving_twoptm': lambda x: x * 2,
-            # KICKING
-            #   PAT Made
-            'kicking_xpmade': lambda x: x * 1,
-            #   FG Made
-            'kicking_fgm_yds': lambda x: 5 if x >= 50 else (3 if x > 0 else 0),
-            # INDIVIDUAL DEFENSIVE PLAYERS
-            #   Blocked Kick (punt, FG, PAT)
-            'defense_puntblk': lambda x: x * 1,
-            'defense_fgblk': lambda x: x * 1,
-            'defense_xpblk': lambda x: x * 1,
-            #   Safety
-            'defense_safe': lambda x: x * 2,
-            #   Def 2-point Return
-            'defense_two_pt_return': lambda x: x * 2,  # This is a custom one
-        }
-    elif method == 'fantasydata.com':
-        # The stats in this dictionary match the order and scoring in
-        # https://fantasydata.com/developers/fantasy-scoring-system/nfl
-        # for individual players.
-        ppr = True
-        player_scoring_dict = {
-            # OFFENSIVE PLAYERS
-            #   Passing
-            'passing_yds': lambda x: x * .04,
-            'passing_tds': lambda x: x * 4,
-            'passing_ints': lambda x: x * -2,
-            #   Rushing
-            'rushing_yds': lambda x: x * .1,
-            'rushing_tds': lambda x: x * 6,
-            #   Receiving
-            'receiving_rec': lambda x: x * 1 if ppr else x * 0.5,
-            'receiving_yds': lambda x: x * .1,
-            'receiving_tds': lambda x: x * 6,
-            #   2-point conversions
-            'passing_twoptm': lambda x: x * 2,
-            'rushing_twoptm': lambda x: x * 2,
-            'receiving_twoptm': lambda x: x * 2,
-            'kickret_tds': lambda x: x * 6,
-            #   Fumbles
-            'fumbles_lost': lambda x: x * -2,
-            'fumbles_rec_tds': lambda x: x * 6,
-            # INDIVIDUAL DEFENSIVE PLAYERS
-            #   Tackles/Hits
-            'defense_tkl': lambda x: x * 1,
-            'defense_ast': lambda x: x * 0.5,
-            'defense_sk': lambda x: x * 2,
-            'defense_sk_yds': lambda x: x * .1,
-            'defense_tkl_loss': lambda x: x * 1,
-            'defense_qbhit': lambda x: x * 1,
-            #   Pass Defense
-            'defense_pass_def': lambda x: x * 1,
-            'defense_int': lambda x: x * 3,
-            #   Run Defense
-            'defense_ffum': lambda x: x * 3,
-            'defense_frec': lambda x: x * 3,
-            #   Scoring on Defense
-            'defense_tds': lambda x: x * 6,
-            'defense_two_pt_return': lambda x: x * 2,  # This is a custom one
-            # KICKING
-            'kicking_xpmade': lambda x: x * 1,
-            'kicking_fgm_yds': lambda x: 5 if x >= 50 else (3 if x > 0 else 0),
-        }
-    else:
-        raise ValueError("{} is not a valid value for `method`!".format(method))
-    return player_scoring_dict
+    return parse_rules(load_ruleset(method)['player'])
 
 
-def get_team_scoring_dict():
+def get_team_scoring_dict(method='nfl.com'):
     """Returns a dictionary of scoring rules for each team stat. All stats in
     this dictionary have the `team_` prefix to differentiate team-level stats
     from individual player stats, which have overlapping stat keys. The stat
     keys after the `team_` prefix (i.e. `defense_sk`) are part of the nflgame
-    API except for `defense_two_pt_return` and `points_allowed`. The stats in
-    this dictionary match the order and scoring in
+    API except for `defense_two_pt_return` and `points_allowed`. The rules come
+    from the `team` section of the ruleset loaded by `load_ruleset(method)`.
+    Both built-in rulesets match the scoring in
     https://fantasydata.com/developers/fantasy-scoring-system/nfl for team
-    defense/special teams.
-    
-    It also matches my NFL.com league's rules
+    defense/special teams, which also matches my NFL.com league's rules
     """
-    team_scoring_dict = {
-        # TEAM DEFENSE / SPECIAL TEAMS
-        'team_defense_sk': lambda x: x * 1,
-        'team_defense_int': lambda x: x * 2,
-        'team_defense_frec': lambda x: x * 2,
-        'team_defense_safe': lambda x: x * 2,
-        'team_defense_tds': lambda x: x * 6,
-        'team_kickret_tds': lambda x: x * 6,
-        'team_puntret_tds': lambda x: x * 6,
-        'team_defense_two_pt_return': lambda x: x * 2,  # This is a custom one
-        'team_points_allowed': lambda x: team_points_allowed_fn(x)
-    }
-    return team_scoring_dict
+    return parse_rules(load_ruleset(method)['team'])
+
+
+# The points allowed rule of the default ruleset, compiled once for
+# team_points_allowed_fn
+_TEAM_POINTS_ALLOWED_RULE = get_team_scoring_dict()['team_points_allowed']
+
+
+def team_points_allowed_fn(points_allowed):
+    """Return fantasy points scored by a defense based on the number of points
+    they allowed. Based on point scale found on
+    https://fantasydata.com/developers/fantasy-scoring-system/nfl
+    """
+    return _TEAM_POINTS_ALLOWED_RULE(points_allowed)
+
+
+class CompiledRules(object):
+    """A dictionary of scoring rules compiled into NumPy arrays. Linear rules
+    are stacked into a single coefficient vector, tier rules are evaluated
+    with `np.select`, and any other callable falls back to being applied one
+    value at a time.
+    """
+
+    def __init__(self, scoring_dict):
+        self.linear_stats = []
+        linear_points = []
+        self.tier_rules = []
+        self.other_rules = []
+        for stat in sorted(scoring_dict):
+            rule = scoring_dict[stat]
+            if isinstance(rule, LinearRule):
+                self.linear_stats.append(stat)
+                linear_points.append(rule.points)
+            elif isinstance(rule, TierRule):
+                self.tier_rules.append((stat, rule))
+            else:
+                self.other_rules.append((stat, rule))
+        self.linear_points = np.array(linear_points, dtype=float)
+        self.stats = (
+            self.linear_stats + [stat for stat, _ in self.tier_rules] +
+            [stat for stat, _ in self.other_rules]
+        )
+
+    def score_frame(self, stats_df, rows):
+        """Return a dataframe with a `<stat>_score` column for every rule
+        whose stat is in `stats_df`. Scores are NaN outside of the boolean
+        `rows` mask. `stats_df` must not contain NaNs.
+        """
+        for stat in self.stats:
+            if stat not in stats_df.columns:
+                print("Warning: {} not found in stats_df".format(stat))
+        linear_mask = np.array(
+            [stat in stats_df.columns for stat in self.linear_stats],
+            dtype=bool,
+        )
+        linear_stats = [stat for stat, present
+                        in zip(self.linear_stats, linear_mask) if present]
+        other_rules = [(stat, rule) for stat, rule
+                       in self.tier_rules + self.other_rules
+                       if stat in stats_df.columns]
+        n_scores = len(linear_stats) + len(other_rules)
+        scores = np.empty((len(stats_df), n_scores))
+        scores[:, :len(linear_stats)] = (
+            stats_df[linear_stats].values.astype(float) *
+            self.linear_points[linear_mask]
+        )
+        for j, (stat, rule) in enumerate(other_rules, len(linear_stats)):
+            values = stats_df[stat].values.astype(float)
+            if isinstance(rule, TierRule):
+                scores[:, j] = rule.evaluate(values)
+            else:
+                scores[:, j] = [rule(x) for x in values]
+        scores[~rows] = np.nan
+        score_columns = [stat + '_score' for stat in linear_stats] + [
+            stat + '_score' for stat, _ in other_rules
+        ]
+        return pd.DataFrame(scores, index=stats_df.index,
+                            columns=score_columns)
+
+
+class ScoringEngine(object):
+    """Team and player scoring dictionaries compiled for vectorized scoring of
+    a whole stats dataframe at once. Team rules only apply to rows whose
+    position is 'DEFENSE' and player rules only apply to all other rows.
+    """
+
+    def __init__(self, team_scoring_dict, player_scoring_dict):
+        self.team_rules = CompiledRules(team_scoring_dict)
+        self.player_rules = CompiledRules(player_scoring_dict)
+        self.ruleset_hash = None
+
+    def score(self, stats_df):
+        """Return a dataframe with all the original stats in `stats_df`, the
+        fantasy score of each stat, and a `total_score` column
+        """
+        scores_df = stats_df.copy().fillna(0)
+        first_columns = ['season', 'week', 'team', 'position', 'player']
+        if 'gsis_id' in scores_df.columns:
+            first_columns.append('gsis_id')
+        team_columns = [c for c in scores_df.columns if c.startswith('team_')]
+        player_columns = [c for c in scores_df.columns
+                          if c not in first_columns and c not in team_columns]
+        team_score_columns = [c + '_score' for c in team_columns]
+        player_score_columns = [c + '_score' for c in player_columns]
+        final_columns_order = (
+            first_columns + team_columns + player_columns +
+            team_score_columns + player_score_columns + ['total_score']
+        )
+        defense_rows = (scores_df['position'] == 'DEFENSE').values
+        scores_df = pd.concat([
+            scores_df,
+            self.team_rules.score_frame(scores_df, defense_rows),
+            self.player_rules.score_frame(scores_df, ~defense_rows),
+        ], axis=1)
+        scores_df['total_score'] = (
+            scores_df[team_score_columns + player_score_columns].sum(axis=1)
+        )
+        scores_df = scores_df[final_columns_order]
+        scores_df['week'] = scores_df['week'].astype(int)
+        return scores_df
 
 
 def calc_scores(stats_df, team_scoring_dict, player_scoring_dict):
@@ -163,42 +298,81 @@ def calc_scores(stats_df, team_scoring_dict, player_scoring_dict):
     and players, return a dataframe with all the original stats and fantasy
     scoring on those stats.
     """
-    scores_df = stats_df.copy().fillna(0)
-    first_columns = ['season', 'week', 'team', 'position', 'player']
-    team_columns = [c for c in scores_df.columns if c.startswith('team_')]
-    player_columns = [c for c in scores_df.columns
-                      if c not in first_columns and c not in team_columns]
-    team_score_columns = [c + '_score' for c in team_columns]
-    player_score_columns = [c + '_score' for c in player_columns]
-    final_columns_order = (
-        first_columns + team_columns + player_columns + team_score_columns +
-        player_score_columns + ['total_score']
-    )
-    for stat in team_scoring_dict:
-        print "Computing {}:".format(stat)
-        defense_rows = (scores_df['position'] == 'DEFENSE')
-        if stat in scores_df.columns:
-            scores_df.loc[defense_rows, stat + '_score'] = (
-                scores_df.loc[defense_rows, stat].apply(
-                    team_scoring_dict[stat]
-                )
-            )
-        else:
-            print("Warning: {} not found in stats_df".format(stat))
-    for stat in player_scoring_dict:
-        print "Computing {}:".format(stat)
-        player_rows = (scores_df['position'] != 'DEFENSE')
-        if stat in scores_df.columns:
-            scores_df.loc[player_rows, stat + '_score'] = (
-                scores_df.loc[player_rows, stat].apply(
-                    player_scoring_dict[stat]
-                )
-            )
-        else:
-            print("Warning: {} not found in stats_df".format(stat))
-    scores_df['total_score'] = (
-        scores_df[team_score_columns + player_score_columns].sum(axis=1)
-    )
-    scores_df = scores_df[final_columns_order]
-    scores_df['week'] = scores_df['week'].astype(int)
-    return scores_df
+    engine = ScoringEngine(team_scoring_dict, player_scoring_dict)
+    return engine.score(stats_df)
+
+
+def compile_ruleset(ruleset):
+    """Returns a `ScoringEngine` for a ruleset dictionary (see
+    `load_ruleset`). Engines are cached by `ruleset_hash`, so a ruleset is
+    only compiled once per process no matter how many times it is loaded. The
+    engine holds only NumPy arrays and rule objects, so it can be pickled and
+    sent to worker processes.
+    """
+    key = ruleset_hash(ruleset)
+    if key not in _ENGINE_CACHE:
+        engine = ScoringEngine(parse_rules(ruleset['team']),
+                               parse_rules(ruleset['player']))
+        engine.ruleset_hash = key
+        _ENGINE_CACHE[key] = engine
+    return _ENGINE_CACHE[key]
+
+
+def _linear_points_matrix(compiled_rules, columns):
+    """Returns the stats in `columns` that have a linear rule in any of
+    `compiled_rules` (`CompiledRules` objects), and a stats x compiled rules
+    matrix of points per unit of each stat (0 where one has no linear rule for
+    it)
+    """
+    linear_stats = sorted(set(
+        stat for rules in compiled_rules for stat in rules.linear_stats
+        if stat in columns
+    ))
+    rows = {stat: i for i, stat in enumerate(linear_stats)}
+    points = np.zeros((len(linear_stats), len(compiled_rules)))
+    for j, rules in enumerate(compiled_rules):
+        for stat, stat_points in zip(rules.linear_stats, rules.linear_points):
+            if stat in rows:
+                points[rows[stat], j] = stat_points
+    return linear_stats, points
+
+
+def score_rulesets(stats_df, rulesets):
+    """Returns a dataframe of total fantasy scores for every row of `stats_df`
+    with one column per ruleset, named after the ruleset. All rulesets are
+    scored together: the linear rules of every ruleset are stacked into one
+    stats x rulesets coefficient matrix so the linear part of every total
+    comes from a single matrix product, and each distinct tier rule is only
+    evaluated once no matter how many rulesets share it. Rulesets are
+    compiled with `compile_ruleset`, so scoring many frames with the same
+    rulesets (e.g. one week at a time) only compiles them once.
+    """
+    names = [ruleset['name'] for ruleset in rulesets]
+    if len(set(names)) != len(names):
+        raise ValueError("Ruleset names must be unique: {}".format(names))
+    engines = [compile_ruleset(ruleset) for ruleset in rulesets]
+    defense_rows = (stats_df['position'] == 'DEFENSE').values
+    totals = np.zeros((len(stats_df), len(rulesets)))
+    sections = [([engine.team_rules for engine in engines], defense_rows),
+                ([engine.player_rules for engine in engines], ~defense_rows)]
+    for compiled_rules, rows in sections:
+        linear_stats, points = _linear_points_matrix(compiled_rules,
+                                                     stats_df.columns)
+        values = stats_df[linear_stats].fillna(0).values.astype(float)
+        section_totals = values.dot(points)
+        rule_scores = {}
+        for j, rules in enumerate(compiled_rules):
+            for stat, rule in rules.tier_rules + rules.other_rules:
+                if stat not in stats_df:
+                    continue
+                key = (stat, repr(rule))
+                if key not in rule_scores:
+                    values = stats_df[stat].fillna(0).values.astype(float)
+                    if isinstance(rule, TierRule):
+                        rule_scores[key] = rule.evaluate(values)
+                    else:
+                        rule_scores[key] = np.array([rule(x) for x in values])
+                section_totals[:, j] += rule_scores[key]
+        section_totals[~rows] = 0
+        totals += section_totals
+    return pd.DataFrame(totals, index=stats_df.index, columns=names)